@@ -1,7 +1,20 @@
 import os
 import sys
 import time
+import json
+import array
+import bisect
+import gzip
+import zlib
+import hashlib
+import itertools
+import contextlib
+import functools
+import mmap
+import struct
+import tempfile
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
 from PySide import QtGui, QtCore, QtNetwork
 
 ## written by Frank Rueter with (lots of) help from Aaron Richiger
@@ -12,28 +25,182 @@ class NukeError(Exception):
     def __str__(self):
         return '''This is the ol' "A PythonObject is not attached to a node" error that we need to work around for now'''
 
+def parseBool(text):
+    '''Return the boolean saved as text, raise ValueError for anything that is not "True" or "False"'''
+    if text == 'True':
+        return True
+    if text == 'False':
+        return False
+    raise ValueError('not a boolean: %r' % text)
+
 class Task(object):
     '''
     Model for a task. Task attributes are:
        name - short description of the task
        priority - integer
        status - float (0 > waiting to start, 1 > finished)
+       finishedTime - when the task was finished, 0 if it isn't
+    Tasks can hold subtasks. Every task keeps a count of the statuses and priorities
+    of itself and all its subtasks, so rollups never have to walk the tree.
     '''
-
-    def __init__(self, name='new task', priority=1, status=0):
+    # FIELDS THAT ARE SAVED TO DISK: NAME, TYPE TO PARSE THE SAVED TEXT WITH, DEFAULT FOR FILES WRITTEN WITH AN OLDER SCHEMA
+    SCHEMAVERSION = 3
+    SCHEMA = (('id', int, 0),
+              ('parentId', int, 0),
+              ('name', unicode, 'new task'),
+              ('priority', int, 1),
+              ('status', int, 0),
+              ('expanded', parseBool, False),
+              ('finishedTime', float, 0.0))
+
+    def __init__(self, name='new task', priority=1, status=0, taskId=0, parentId=0, expanded=False, finishedTime=0.0):
+        self.id = taskId
         self.name = name
         self.priority = priority
         self.status = status
-        self.index = 0
+        # FINISHED BEFORE FINISH TIMES WERE SAVED - START THE CLOCK NOW. THE TIME HAS TO BE SAVED OR IT STARTS AGAIN WITH EVERY LOAD
+        self.finishedTimeAdded = status == 2 and not finishedTime
+        if self.finishedTimeAdded:
+            finishedTime = time.time()
+        self.finishedTime = finishedTime
+        # TRUE FOR TASKS THAT WERE PAGED IN FROM THE ARCHIVE AND ARE NOT SAVED WITH THE OTHER TASKS
+        self.archived = False
+        # ROW OF THE TASK IN THE VIEW, -1 UNTIL THE STORE SHOWS IT
+        self.index = -1
+        # STABLE POSITION IN THE STORE THAT BREAKS TIES WHEN SORTING AND THE SORT KEY THE TASK WAS LAST SHOWN WITH
+        self.rank = 0
+        self.placedKey = None
+        # THE HISTORY OF THE STORE THE TASK IS IN, RECORDS STATUS AND PRIORITY CHANGES
+        self.history = None
+        self.parent = None
+        self.children = []
+        self.expanded = expanded
+        # ONLY USED UNTIL THE TASK HAS BEEN HOOKED UP WITH ITS PARENT AFTER LOADING
+        self.pendingParentId = parentId
+        self.statusCounts = [0, 0, 0]
+        self.statusCounts[status] = 1
+        self.priorityCounts = {priority: 1}
         
     def setName(self, name):
         self.name = name
 
     def setPriority(self, priority):
+        if priority == self.priority:
+            return
+        for task in self.selfAndAncestors():
+            task.removePriorityCounts({self.priority: 1})
+            task.addPriorityCounts({priority: 1})
         self.priority = priority
+        if self.history is not None:
+            self.history.record(self.id, TaskHistory.PRIORITY, priority)
         
     def setStatus(self, status):
+        if status == self.status:
+            return
+        for task in self.selfAndAncestors():
+            task.statusCounts[self.status] -= 1
+            task.statusCounts[status] += 1
         self.status = status
+        self.finishedTime = time.time() if status == 2 else 0.0
+        if self.history is not None:
+            self.history.record(self.id, TaskHistory.STATUS, status)
+
+    def asDict(self):
+        '''Return the saved fields of this task as a dictionary'''
+        data = dict((field, getattr(self, field)) for field, fieldType, default in Task.SCHEMA)
+        if self.parent is None:
+            # READ BACK BUT NOT HOOKED UP, E.G. ARCHIVED TASKS THAT ARE COPIED OVER WHEN THE ARCHIVE IS REWRITTEN
+            data['parentId'] = self.pendingParentId
+        return data
+
+    @staticmethod
+    def fromDict(data):
+        '''Build a task from a dictionary made by asDict, missing fields get their default, a status out of range is repaired'''
+        data = dict((field, data.get(field, default)) for field, fieldType, default in Task.SCHEMA)
+        return Task(name=data['name'],
+                    priority=data['priority'],
+                    status=min(max(data['status'], 0), 2),
+                    taskId=data['id'],
+                    parentId=data['parentId'],
+                    expanded=data['expanded'],
+                    finishedTime=data['finishedTime'])
+
+    @property
+    def parentId(self):
+        return self.parent.id if self.parent else 0
+
+    def addChild(self, child, position=None):
+        '''Make child a subtask of this task and add its counts to the rollups of this task and its ancestors'''
+        child.parent = self
+        child.pendingParentId = 0
+        if position is None:
+            self.children.append(child)
+        else:
+            self.children.insert(position, child)
+        for task in self.selfAndAncestors():
+            for i, count in enumerate(child.statusCounts):
+                task.statusCounts[i] += count
+            task.addPriorityCounts(child.priorityCounts)
+
+    def removeChild(self, child):
+        '''Detach child from this task and take its counts out of the rollups of this task and its ancestors'''
+        self.children.remove(child)
+        child.parent = None
+        for task in self.selfAndAncestors():
+            for i, count in enumerate(child.statusCounts):
+                task.statusCounts[i] -= count
+            task.removePriorityCounts(child.priorityCounts)
+
+    def addPriorityCounts(self, priorityCounts):
+        for priority, count in priorityCounts.iteritems():
+            self.priorityCounts[priority] = self.priorityCounts.get(priority, 0) + count
+
+    def removePriorityCounts(self, priorityCounts):
+        for priority, count in priorityCounts.iteritems():
+            self.priorityCounts[priority] -= count
+            if not self.priorityCounts[priority]:
+                del self.priorityCounts[priority]
+
+    def rollupStatus(self):
+        '''Return the status of this task and all its subtasks combined'''
+        total = sum(self.statusCounts)
+        if self.statusCounts[2] == total:
+            return 2
+        if self.statusCounts[0] == total:
+            return 0
+        return 1
+
+    def rollupPriority(self):
+        '''Return the highest priority found in this task and its subtasks'''
+        return max(self.priorityCounts)
+
+    def subTaskCount(self):
+        return sum(self.statusCounts) - 1
+
+    def finishedSubTaskCount(self):
+        return self.statusCounts[2] - (self.status == 2)
+
+    def selfAndAncestors(self):
+        task = self
+        while task:
+            yield task
+            task = task.parent
+
+    def depth(self):
+        return sum(1 for task in self.selfAndAncestors()) - 1
+
+    def isShownInTree(self):
+        '''Return True if all ancestors are expanded'''
+        return all(task.expanded for task in self.selfAndAncestors() if task is not self)
+
+    def descendants(self, expandedOnly=False):
+        '''Yield all subtasks depth first. If expandedOnly is True skip the subtasks of collapsed tasks'''
+        if expandedOnly and not self.expanded:
+            return
+        for child in self.children:
+            yield child
+            for task in child.descendants(expandedOnly):
+                yield task
         
     def __repr__(self):
         return 'Task(name=%s, priority=%D, status=%d' % (self.index, self.name)
@@ -41,83 +208,1174 @@ class Task(object):
     def __str__(self):
         return '-' * 20 + '\np%s:\t\t%s\t\t (%s)' % (self.priority, self.name, ['waiting', 'in progress', 'finished'][self.status])
 
+class TaskSnapshot(object):
+    '''
+    Read-only, memory-mapped binary copy of a task file. Reading the tasks back from it in one pass is a lot faster
+    than parsing the xml file, all tasks are still built at start up.
+    The file holds a header, one fixed-size record per task and a string table for the task names:
+       header - magic, version, task count, highest task id, modification time and size of the xml file the snapshot was
+                taken from, size of the string table and a checksum of records and string table
+       record - id, parent id, priority, status, expanded, finish time, offset and length of the name in the string table
+    '''
+    MAGIC = 'TDLS'
+    VERSION = 4
+    HEADER = struct.Struct('<4sHHIIdQII')
+    RECORD = struct.Struct('<IIiBBxxdII')
+    HASSUBTASKS = 1
+
+    def __init__(self, snapshotFile, sourceFile):
+        self.snapshotFile = snapshotFile
+        self.count = 0
+        self.lastId = 0
+        self.flags = 0
+        self.fileObj = None
+        self.map = None
+        self.open(sourceFile)
+
+    def open(self, sourceFile):
+        '''Map the snapshot into memory. Leave it closed if it is missing, outdated or was written by a different version'''
+        if not (os.path.isfile(self.snapshotFile) and os.path.isfile(sourceFile)):
+            return
+        if os.path.getsize(self.snapshotFile) < TaskSnapshot.HEADER.size:
+            return
+
+        self.fileObj = open(self.snapshotFile, 'rb')
+        self.map = mmap.mmap(self.fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, count, lastId, sourceMtime, sourceSize, namesSize, checksum = TaskSnapshot.HEADER.unpack_from(self.map, 0)
+        if magic != TaskSnapshot.MAGIC or version != TaskSnapshot.VERSION or\
+           sourceMtime != os.path.getmtime(sourceFile) or sourceSize != os.path.getsize(sourceFile):
+            # STALE OR FOREIGN SNAPSHOT - FALL BACK TO THE XML FILE
+            self.close()
+            return
+        if len(self.map) != TaskSnapshot.HEADER.size + count * TaskSnapshot.RECORD.size + namesSize or\
+           zlib.crc32(self.map[TaskSnapshot.HEADER.size:]) & 0xffffffff != checksum:
+            # CUT SHORT OR DAMAGED, IT IS ONLY A CACHE SO FALL BACK TO THE XML FILE
+            self.close()
+            return
+        self.count = count
+        self.lastId = lastId
+        self.flags = flags
+        self.stringsOffset = TaskSnapshot.HEADER.size + count * TaskSnapshot.RECORD.size
+
+    def isValid(self):
+        return self.map is not None
+
+    def hasSubTasks(self):
+        return bool(self.flags & TaskSnapshot.HASSUBTASKS)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fileObj is not None:
+            self.fileObj.close()
+            self.fileObj = None
+        self.count = 0
+
+    def taskAt(self, i):
+        '''Build the task stored in record i'''
+        offset = TaskSnapshot.HEADER.size + i * TaskSnapshot.RECORD.size
+        taskId, parentId, priority, status, expanded, finishedTime, nameOffset, nameLength = TaskSnapshot.RECORD.unpack_from(self.map, offset)
+        start = self.stringsOffset + nameOffset
+        name = self.map[start:start + nameLength].decode('utf-8')
+        return Task(name=name, priority=priority, status=status, taskId=taskId, parentId=parentId, expanded=bool(expanded), finishedTime=finishedTime)
+
+    @staticmethod
+    def write(snapshotFile, tasks, lastId, sourceFile):
+        '''Write a snapshot of tasks that belongs to the current version of sourceFile. Parents have to come before their subtasks'''
+        records = []
+        names = []
+        nameOffset = 0
+        flags = 0
+        for task in tasks:
+            name = task.name if isinstance(task.name, str) else task.name.encode('utf-8')
+            records.append(TaskSnapshot.RECORD.pack(task.id, task.parentId, task.priority, task.status, task.expanded, task.finishedTime, nameOffset, len(name)))
+            names.append(name)
+            nameOffset += len(name)
+            if task.parent:
+                flags |= TaskSnapshot.HASSUBTASKS
+        body = ''.join(records) + ''.join(names)
+        header = TaskSnapshot.HEADER.pack(TaskSnapshot.MAGIC, TaskSnapshot.VERSION, flags, len(records), lastId,
+                                          os.path.getmtime(sourceFile), os.path.getsize(sourceFile), nameOffset,
+                                          zlib.crc32(body) & 0xffffffff)
+
+        # WRITE NEXT TO THE OLD FILE AND SWAP SO A MAPPED READER NEVER SEES A HALF WRITTEN SNAPSHOT
+        with safeWrite(snapshotFile) as f:
+            f.write(header)
+            f.write(body)
+
+
+class TaskReader(object):
+    '''
+    Iterate over the tasks saved in tasksFile one by one without holding the whole file in memory.
+    Reads the binary snapshot if there is an up-to-date one, otherwise streams the xml file.
+    After iterating lastId holds the highest task id handed out for this file.
+    '''
+
+    def __init__(self, tasksFile, useSnapshot=True):
+        self.tasksFile = tasksFile
+        self.useSnapshot = useSnapshot
+        self.lastId = 0
+
+    def __iter__(self):
+        if not (self.tasksFile and os.path.isfile(self.tasksFile)) or not os.path.getsize(self.tasksFile):
+            # NOTHING SAVED YET
+            return iter([])
+        if self.useSnapshot:
+            try:
+                snapshot = TaskSnapshot(snapshotPathFromSettings(self.tasksFile), self.tasksFile)
+            except (EnvironmentError, ValueError, struct.error) as e:
+                print 'ignoring unreadable task snapshot:', e
+            else:
+                if snapshot.isValid():
+                    return self.iterSnapshot(snapshot)
+        return self.iterXml()
+
+    def iterSnapshot(self, snapshot):
+        count = 0
+        try:
+            self.lastId = snapshot.lastId
+            for i in range(snapshot.count):
+                task = snapshot.taskAt(i)
+                count += 1
+                yield task
+        except (ValueError, IndexError, struct.error) as e:
+            # THE SNAPSHOT IS ONLY A CACHE. IT WAS WRITTEN FROM THE SAME TASKS IN THE SAME ORDER, SO CARRY ON IN THE XML FILE
+            print 'ignoring damaged task snapshot:', e
+            for task in itertools.islice(self.iterXml(), count, None):
+                yield task
+        finally:
+            snapshot.close()
+
+    def iterXml(self):
+        count = 0
+        root = None
+        for event, element in ET.iterparse(self.tasksFile, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                if element.tag == 'ToDoPanel':
+                    # THE HIGHEST ID MAY BELONG TO AN ARCHIVED TASK THAT IS NOT IN THE FILE ANY MORE
+                    self.lastId = max(self.lastId, int(element.get('lastId', 0)))
+                continue
+            if element.tag != 'Task':
+                continue
+            count += 1
+            # ONLY READ WHAT IS IN THE SCHEMA, FIELDS MISSING IN OLDER FILES OR THAT CAN'T BE READ GET THEIR DEFAULT
+            data = {}
+            for field, fieldType, default in Task.SCHEMA:
+                text = element.findtext(field)
+                try:
+                    data[field] = default if text is None else fieldType(text)
+                except ValueError:
+                    print 'ignoring invalid %s of task %s in %s: %r' % (field, count, self.tasksFile, text)
+                    data[field] = default
+            # THE ROOT HOLDS ON TO EVERY ELEMENT READ SO FAR, LET GO OF THEM SO MEMORY DOESN'T GROW WITH THE FILE
+            root.clear()
+
+            # FILES WRITTEN BEFORE TASKS HAD IDS GET THEM ASSIGNED IN ORDER
+            data['id'] = data['id'] or count
+            self.lastId = max(self.lastId, data['id'])
+            yield Task.fromDict(data)
+
+
+class TaskHistory(object):
+    '''
+    Log of the status and priority changes of all tasks in a store, kept in a few packed arrays rather than an object per change.
+    Each event stores the seconds since the previous one. A sync event holding the full time (as seconds since baseTime)
+    starts every batch of events and is added whenever a gap doesn't fit.
+    Only events that haven't been written yet are held in memory, they are appended to the history file on every save.
+    The file is cut back to the latest MAXEVENTS events once it holds twice as many
+    '''
+    STATUS = 0
+    PRIORITY = 1
+    SYNC = 255
+    MAGIC = 'TDLH'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHd')
+    # KIND, SECONDS SINCE THE PREVIOUS EVENT, TASK ID, NEW VALUE
+    RECORD = struct.Struct('<BHii')
+    MAXEVENTS = 100000
+    # ONLY REACHED IF THE EVENTS CAN'T BE SAVED
+    MAXPENDING = 10000
+    READCHUNK = 4096
+
+    def __init__(self, historyFile):
+        self.historyFile = historyFile
+        self.baseTime = self.readBaseTime()
+        if self.baseTime is None:
+            self.baseTime = float(int(time.time()))
+        self.clear()
+
+    def clear(self):
+        '''Forget all events that are held in memory'''
+        self.kinds = array.array('B')
+        self.deltas = array.array('H')
+        self.ids = array.array('i')
+        self.values = array.array('i')
+        self.lastTime = None
+
+    def readBaseTime(self):
+        '''Return the base time of the history file, None if there is no usable one'''
+        if not (self.historyFile and os.path.isfile(self.historyFile)):
+            return None
+        with open(self.historyFile, 'rb') as f:
+            header = f.read(TaskHistory.HEADER.size)
+        if len(header) < TaskHistory.HEADER.size:
+            return None
+        magic, version, baseTime = TaskHistory.HEADER.unpack(header)
+        if magic != TaskHistory.MAGIC or version != TaskHistory.VERSION:
+            return None
+        return baseTime
+
+    def append(self, kind, delta, taskId, value):
+        self.kinds.append(kind)
+        self.deltas.append(delta)
+        self.ids.append(taskId)
+        self.values.append(value)
+
+    def record(self, taskId, kind, value):
+        '''Record that the status or priority (kind) of the task with taskId changed to value just now'''
+        now = int(time.time())
+        value = max(-0x80000000, min(value, 0x7fffffff))
+        if self.lastTime is None or not 0 <= now - self.lastTime <= 0xffff:
+            self.append(TaskHistory.SYNC, 0, 0, int(now - self.baseTime))
+            self.lastTime = now
+        elif now == self.lastTime and self.kinds[-1] == kind and self.ids[-1] == taskId:
+            # SAME CHANGE WITHIN THE SAME SECOND, E.G. WHILE DRAGGING THE PRIORITY - ONLY THE RESULT COUNTS
+            self.values[-1] = value
+            return
+        self.append(kind, now - self.lastTime, taskId, value)
+        self.lastTime = now
+        if len(self.kinds) > TaskHistory.MAXPENDING:
+            self.cut(self.kinds, self.deltas, self.ids, self.values, len(self.kinds) / 2)
+
+    def changeId(self, oldId, newId):
+        '''Hand the events of the task with oldId over to newId'''
+        for i, taskId in enumerate(self.ids):
+            if taskId == oldId and self.kinds[i] != TaskHistory.SYNC:
+                self.ids[i] = newId
+
+    def cut(self, kinds, deltas, ids, values, keep):
+        '''Drop all but the latest keep events from the given arrays, starting what is left with a sync event'''
+        start = len(kinds) - keep
+        seconds = 0
+        for i in range(start + 1):
+            seconds = values[i] if kinds[i] == TaskHistory.SYNC else seconds + deltas[i]
+        for column in (kinds, deltas, ids, values):
+            del column[:start]
+        # THE FIRST EVENT LEFT HAPPENED AT THE TIME OF THE NEW SYNC EVENT
+        deltas[0] = 0
+        for column, value in zip((kinds, deltas, ids, values), (TaskHistory.SYNC, 0, 0, seconds)):
+            column.insert(0, value)
+
+    def pack(self, kinds, deltas, ids, values, baseTime):
+        '''Return the given events as records for a file with baseTime'''
+        shift = int(self.baseTime - baseTime)
+        return ''.join(TaskHistory.RECORD.pack(kinds[i], deltas[i], ids[i], values[i] + shift if kinds[i] == TaskHistory.SYNC else values[i])
+                       for i in range(len(kinds)))
+
+    def save(self):
+        '''Append the events held in memory to the history file'''
+        if not (self.historyFile and self.kinds):
+            return
+        fileBaseTime = self.readBaseTime()
+        if fileBaseTime is None:
+            with safeWrite(self.historyFile) as f:
+                f.write(TaskHistory.HEADER.pack(TaskHistory.MAGIC, TaskHistory.VERSION, self.baseTime))
+            fileBaseTime = self.baseTime
+        with appendWrite(self.historyFile) as f:
+            f.write(self.pack(self.kinds, self.deltas, self.ids, self.values, fileBaseTime))
+        self.baseTime = fileBaseTime
+        self.clear()
+
+        if os.path.getsize(self.historyFile) > TaskHistory.HEADER.size + 2 * TaskHistory.MAXEVENTS * TaskHistory.RECORD.size:
+            self.compact()
+
+    def compact(self):
+        '''Rewrite the history file with only the latest MAXEVENTS events'''
+        columns = (array.array('B'), array.array('H'), array.array('i'), array.array('i'))
+        for record in self.iterRecords():
+            for column, value in zip(columns, record):
+                column.append(value)
+        if len(columns[0]) > TaskHistory.MAXEVENTS:
+            self.cut(*(columns + (TaskHistory.MAXEVENTS,)))
+        with safeWrite(self.historyFile) as f:
+            f.write(TaskHistory.HEADER.pack(TaskHistory.MAGIC, TaskHistory.VERSION, self.baseTime))
+            f.write(self.pack(*(columns + (self.baseTime,))))
+
+    def iterRecords(self):
+        '''Yield the raw events saved in the history file'''
+        if self.readBaseTime() is None:
+            return
+        size = TaskHistory.RECORD.size
+        with open(self.historyFile, 'rb') as f:
+            f.seek(TaskHistory.HEADER.size)
+            while True:
+                chunk = f.read(size * TaskHistory.READCHUNK)
+                for offset in range(0, len(chunk) - size + 1, size):
+                    yield TaskHistory.RECORD.unpack_from(chunk, offset)
+                if len(chunk) < size * TaskHistory.READCHUNK:
+                    break
+
+    def events(self):
+        '''Yield (time, task id, kind, value) for all events, saved ones first'''
+        fileBaseTime = self.readBaseTime()
+        sources = [(self.iterRecords(), fileBaseTime)] if fileBaseTime is not None else []
+        sources.append((itertools.izip(self.kinds, self.deltas, self.ids, self.values), self.baseTime))
+        for records, baseTime in sources:
+            seconds = 0
+            for kind, delta, taskId, value in records:
+                if kind == TaskHistory.SYNC:
+                    seconds = value
+                    continue
+                seconds += delta
+                yield baseTime + seconds, taskId, kind, value
+
+    def timeInStatus(self, now=None):
+        '''
+        Return how long each task spent in each status as {task id: [waiting, in progress, finished]} in seconds.
+        Time before the first recorded status change of a task is not counted
+        '''
+        now = time.time() if now is None else now
+        totals = {}
+        current = {}
+        for eventTime, taskId, kind, value in self.events():
+            if kind != TaskHistory.STATUS:
+                continue
+            if taskId in current:
+                status, since = current[taskId]
+                if eventTime < since:
+                    # WRITTEN BY ANOTHER PANEL OUT OF ORDER
+                    continue
+                totals[taskId][status] += eventTime - since
+            else:
+                totals[taskId] = [0, 0, 0]
+            current[taskId] = (value, eventTime)
+        for taskId, (status, since) in current.iteritems():
+            totals[taskId][status] += max(0, now - since)
+        return totals
+
+    def statusChanges(self, taskId):
+        '''Return (time, status) for every status change of the task with taskId'''
+        return [(eventTime, value) for eventTime, eventTaskId, kind, value in self.events()
+                if eventTaskId == taskId and kind == TaskHistory.STATUS]
+
+
 class TaskStore(QtCore.QObject):
     '''Stores, filters, sorts and delivers all tasks'''
     
-    def __init__(self, tasksFile):
+    USESNAPSHOT = True
+
+    def __init__(self, tasksFile, load=True):
         super(TaskStore, self).__init__()
-        self.initStore(tasksFile)
+        self.hideFinished = False
+        self.sortActive = False
+        self.initStore(tasksFile, load)
         
-    def initStore(self, tasksFile):
-        '''initialise the task store making sure all tasks are prepared the way we need them'''
+    def initStore(self, tasksFile, load=True):
+        '''
+        initialise the task store making sure all tasks are prepared the way we need them.
+        If load is False the store starts out empty and expects its tasks through appendTasks/finishLoading
+        '''
         
         #print 'initialising store'
         self.setTasksFile(tasksFile)
-        self.loadTasks()
-        self.resetTasks()
+        self.loading = not load
+        self.lastTempId = 0
+        self.addedWhileLoading = []
+        self.orphans = {}
+        # IDS OF TASKS DELETED DURING A BACKGROUND LOAD, THEIR SUBTASKS MAY STILL BE ON THEIR WAY
+        self.removedWhileLoading = set()
+        self.tasksById = None
+        self.archiveReader = None
+        # ARCHIVED SUBTASKS WAITING FOR THEIR PARENT TO BE PAGED IN, BY PARENT ID
+        self.archivedOrphans = {}
+        # IDS OF ARCHIVED TASKS THAT WERE RESTORED OR DELETED AND STILL NEED TO BE TAKEN OUT OF THE ARCHIVE FILE
+        self.archiveRemovals = set()
+        self.firstRank = 0
+        self.lastRank = -1
+        self.history = TaskHistory(historyPathFromSettings(tasksFile) if tasksFile else None)
+        # THE TASKS AS THEY WERE LAST READ FROM OR WRITTEN TO THE TASKS FILE, TO TELL CHANGES MADE THERE FROM CHANGES MADE HERE
+        self.diskState = {}
+        # SET WHEN LOADED TASKS GOT A FINISH TIME THAT IS NOT IN THE TASKS FILE YET
+        self.finishedTimesAdded = False
+        if load:
+            self.loadTasks()
+        else:
+            self.tasks = []
+            self.tasksById = {}
+            self.lastId = 0
+        for task in self.tasks:
+            self.appendRank(task)
+            task.history = self.history
+        if load:
+            self.markSaved()
+            self.finishedTimesAdded = any(task.finishedTimeAdded for task in self.tasks)
+        self.arrangeTasks()
         
     def setTasksFile(self, tasksFile):
         '''set the file that holds the task data'''
         
         self.tasksFile = tasksFile
 
-    def addTask(self):
-        '''Insert a new task into the task store'''
-
-        newTask = Task()
+    def newTaskId(self):
+        '''Return an id that is not used by any task in the store yet'''
+
+        if self.loading:
+            # THE HIGHEST ID IN THE FILE IS NOT KNOWN YET - HAND OUT A TEMPORARY ONE THAT CAN'T CLASH
+            self.lastTempId -= 1
+            return self.lastTempId
+        self.lastId += 1
+        return self.lastId
+
+    def appendRank(self, task):
+        '''Rank task behind all other tasks'''
+        self.lastRank += 1
+        task.rank = self.lastRank
+
+    def addTask(self, parent=None):
+        '''Insert a new task into the task store. If parent is given the new task becomes its first subtask'''
+
+        newTask = Task(taskId=self.newTaskId())
+        self.firstRank -= 1
+        newTask.rank = self.firstRank
+        newTask.history = self.history
+        # STARTS THE CLOCK ON THE NEW TASK'S FIRST STATUS
+        self.history.record(newTask.id, TaskHistory.STATUS, newTask.status)
         self.tasks.insert(0, newTask)
+        if self.tasksById is not None:
+            self.tasksById[newTask.id] = newTask
+        if parent:
+            parent.addChild(newTask, 0)
+            parent.expanded = True
+        if self.loading:
+            self.addedWhileLoading.append(newTask)
         return newTask
 
-    def deleteTask(self):
-        taskToDelete = self.sender().parent().task
-        taskToDelete.index = -2
-        self.tasks = [task for task in self.tasks if taskToDelete != task]
-        self.resetTasks()
+    def taskWithId(self, taskId):
+        '''Return the task with the given id or None'''
+
+        if self.tasksById is None:
+            self.tasksById = dict((task.id, task) for task in self.tasks)
+        return self.tasksById.get(taskId)
+
+    def linkTasks(self, tasks):
+        '''
+        Hook up freshly loaded tasks with their parents. Subtasks whose parent has not turned up yet are held back,
+        subtasks of tasks that were deleted in the meantime are dropped.
+        Return the tasks that made it into the tree, including held back subtasks that found their parent
+        '''
+
+        linked = []
+        dropped = []
+        for task in tasks:
+            if task.pendingParentId in self.removedWhileLoading:
+                # THE PARENT WAS DELETED BEFORE ITS SUBTASKS CAME IN, THEY GO WITH IT
+                self.removedWhileLoading.add(task.id)
+                dropped.append(task)
+                continue
+            if task.pendingParentId:
+                parent = self.taskWithId(task.pendingParentId)
+                if parent is None:
+                    self.orphans.setdefault(task.pendingParentId, []).append(task)
+                    continue
+                parent.addChild(task)
+            linked.append(task)
+            for child in self.orphans.pop(task.id, []):
+                task.addChild(child)
+                linked.append(child)
+                linked.extend(child.descendants())
+        if dropped:
+            self.removeTasks(dropped)
+        return linked
+
+    def appendTasks(self, tasks):
+        '''
+        Add tasks that were loaded in the background behind the ones already in the store.
+        Return the tasks that made it into the tree
+        '''
+
+        for task in tasks:
+            self.tasks.append(task)
+            self.appendRank(task)
+            task.history = self.history
+            self.tasksById[task.id] = task
+            self.diskState[task.id] = (task.name, task.priority, task.status, task.expanded, task.pendingParentId)
+            self.lastId = max(self.lastId, task.id)
+            if task.finishedTimeAdded:
+                self.finishedTimesAdded = True
+        return self.linkTasks(tasks)
+
+    def finishLoading(self, lastId):
+        '''
+        Wrap up a background load. lastId is the highest id used in the tasks file.
+        Return the tasks that were added to the tree in the process
+        '''
+
+        self.loading = False
+        self.lastId = max(self.lastId, lastId)
+        # TASKS ADDED DURING THE LOAD ONLY HAVE TEMPORARY IDS
+        for task in self.addedWhileLoading:
+            if task.index == -2:
+                # DELETED AGAIN BEFORE LOADING FINISHED
+                continue
+            self.changeTaskId(task, self.newTaskId())
+        self.addedWhileLoading = []
+
+        # SUBTASKS WHOSE PARENT NEVER SHOWED UP BECOME TOP LEVEL TASKS, UNLESS THEIR PARENT WAS DELETED
+        placed = []
+        for parentId, orphans in self.orphans.items():
+            if parentId in self.removedWhileLoading:
+                self.removeTasks(orphans)
+                continue
+            for task in orphans:
+                task.pendingParentId = 0
+                placed.append(task)
+                placed.extend(task.descendants())
+        self.orphans = {}
+        self.removedWhileLoading = set()
+
+        if not self.tasks:
+            # NO TASKS WERE SAVED
+            placed.append(self.addTask())
+        return placed
+
+    def deleteTask(self, taskToDelete):
+        '''
+        Remove taskToDelete together with all its subtasks. Only the rows below it and the rows of its parents move.
+        Return the tasks whose index changed, including the removed ones
+        '''
+        parent = taskToDelete.parent
+        self.movedRows = {}
+        if taskToDelete.index >= 0:
+            start, end, block = self.takeRows(taskToDelete)
+            self.forgetRows(block)
+            self.numberRows(start, len(self.rows))
+        removedTasks = self.removeTasks([taskToDelete])
+        for task in removedTasks:
+            if task.archived:
+                self.archiveRemovals.add(task.id)
+        if parent:
+            # THE ROLLUPS OF THE PARENTS CHANGED. SAME AS rearrangeTask, BUT ROWS THAT END UP WHERE THEY STARTED DON'T COUNT
+            for t in reversed(list(parent.selfAndAncestors())):
+                self.placeTask(t)
+        moved = self.takeMovedRows()
+        moved.update(removedTasks)
+        return moved
+
+    def removeTasks(self, tasks):
+        '''Take tasks and all their subtasks out of the store and give them an index of -2. Return the removed tasks'''
+        removedTasks = set()
+        for taskToRemove in tasks:
+            if taskToRemove in removedTasks:
+                continue
+            removedTasks.add(taskToRemove)
+            removedTasks.update(taskToRemove.descendants())
+            if taskToRemove.parent:
+                taskToRemove.parent.removeChild(taskToRemove)
+        for task in removedTasks:
+            task.index = -2
+            if self.tasksById is not None:
+                self.tasksById.pop(task.id, None)
+        self.tasks = [task for task in self.tasks if task not in removedTasks]
+        if self.loading:
+            # SUBTASKS HELD BACK FOR A REMOVED TASK GO AS WELL, AND SO DO THE ONES STILL TO COME
+            self.removedWhileLoading.update(task.id for task in removedTasks)
+            heldBack = [orphan for task in removedTasks for orphan in self.orphans.pop(task.id, [])]
+            if heldBack:
+                removedTasks.update(self.removeTasks(heldBack))
+        return removedTasks
+
+    def diskFields(self, task):
+        '''Return the fields of task that are compared with the tasks file'''
+        return (task.name, task.priority, task.status, task.expanded, task.parentId)
+
+    def markSaved(self):
+        '''Remember the tasks as they were just written to the tasks file'''
+        self.diskState = dict((task.id, self.diskFields(task)) for task in self.savedTasks())
+        self.finishedTimesAdded = False
+
+    def changeTaskId(self, task, newId):
+        self.tasksById.pop(task.id, None)
+        oldId, task.id = task.id, newId
+        self.tasksById[task.id] = task
+        self.history.changeId(oldId, task.id)
+
+    def applyChanges(self, newTasks, lastId):
+        '''
+        Bring the store in line with newTasks, freshly read from a tasks file that was changed by someone else.
+        Every task is compared with the way it was last read from or written to the file, so only what was changed in the
+        file is applied. Tasks that were edited, added or deleted here since then are left alone, they win with the next save.
+        lastId is the highest id in that file. Return the lists of added, changed and deleted tasks
+        '''
+        if self.tasksById is None:
+            self.tasksById = dict((task.id, task) for task in self.tasks)
+        self.lastId = max(self.lastId, lastId)
+        fileState = dict((newTask.id, (newTask.name, newTask.priority, newTask.status, newTask.expanded, newTask.pendingParentId))
+                         for newTask in newTasks)
+        for taskId in fileState:
+            task = self.tasksById.get(taskId)
+            if task is not None and taskId not in self.diskState and not task.archived:
+                # ADDED HERE AND NOT SAVED YET, BUT SOMEBODY ELSE TOOK THE SAME ID IN THE FILE
+                self.changeTaskId(task, self.newTaskId())
+
+        added = []
+        changed = []
+        wantedParents = []
+        for newTask in newTasks:
+            task = self.tasksById.get(newTask.id)
+            if task is None:
+                if newTask.id in self.diskState:
+                    # DELETED HERE AND NOT SAVED YET
+                    continue
+                self.tasks.append(newTask)
+                self.appendRank(newTask)
+                newTask.history = self.history
+                self.tasksById[newTask.id] = newTask
+                wantedParents.append((newTask, newTask.pendingParentId))
+                newTask.pendingParentId = 0
+                added.append(newTask)
+                continue
+
+            savedFields = self.diskState.get(task.id)
+            if fileState[task.id] == savedFields or self.diskFields(task) != savedFields:
+                # NOT CHANGED IN THE FILE, OR CHANGED HERE AS WELL
+                continue
+            task.setName(newTask.name)
+            task.setPriority(newTask.priority)
+            task.setStatus(newTask.status)
+            task.finishedTime = newTask.finishedTime
+            task.expanded = newTask.expanded
+            changed.append(task)
+            if task.parentId != newTask.pendingParentId:
+                wantedParents.append((task, newTask.pendingParentId))
+
+        # RE-PARENT ONCE ALL TASKS ARE IN, THE FILE MAY NOT LIST PARENTS FIRST
+        for task, parentId in wantedParents:
+            parent = self.tasksById.get(parentId) if parentId else None
+            if parent and task in parent.selfAndAncestors():
+                # WOULD MAKE A TASK ITS OWN ANCESTOR
+                continue
+            if task.parent:
+                task.parent.removeChild(task)
+            if parent:
+                parent.addChild(task)
+
+        deleted = []
+        # ONLY TASKS THAT WERE IN THE FILE BEFORE AND HAVEN'T BEEN EDITED HERE SINCE. ARCHIVED TASKS ARE NEVER IN THE FILE
+        for task in [t for t in self.tasks if t.id not in fileState and t.id in self.diskState and not t.archived]:
+            if task.index != -2 and self.diskFields(task) == self.diskState[task.id]:
+                deleted.append(task)
+                deleted.extend(task.descendants())
+                self.deleteTask(task)
+        self.diskState = fileState
+        self.arrangeTasks()
+        return added, changed, deleted
+
+    def rootTasks(self):
+        '''Return all top level tasks'''
+
+        return [task for task in self.tasks if task.parent is None]
+
+    def treeOrder(self):
+        '''Yield all tasks so that every parent comes right before its subtasks'''
+
+        for task in self.rootTasks():
+            yield task
+            for subTask in task.descendants():
+                yield subTask
+
+    def savedTasks(self):
+        '''Yield the tasks that go into the tasks file in tree order, i.e. all tasks that are not archived'''
+
+        return (task for task in self.treeOrder() if not task.archived)
+
+    def archiveFile(self):
+        return archivePathFromSettings(self.tasksFile) if self.tasksFile else None
+
+    def archiveFinished(self, maxAge):
+        '''
+        Move all subtrees that have been finished for longer than maxAge seconds from the store to the archive file.
+        Return the tasks that were taken out of the store
+        '''
+        if not self.tasksFile:
+            return []
+        now = time.time()
+        # A SUBTREE IS AS OLD AS ITS MOST RECENTLY FINISHED TASK. SUBTASKS COME BEFORE THEIR PARENT IN REVERSED TREE ORDER
+        lastFinished = {}
+        for task in reversed(list(self.treeOrder())):
+            lastFinished[task] = max([task.finishedTime] + [lastFinished[child] for child in task.children])
+
+        toArchive = []
+        stack = self.rootTasks()
+        while stack:
+            task = stack.pop()
+            if not task.archived and task.rollupStatus() == 2 and now - lastFinished[task] > maxAge:
+                toArchive.append(task)
+            else:
+                stack.extend(task.children)
+        if not toArchive:
+            return []
+
+        # APPEND ONLY, THE TASKS FILE IS WRITTEN AFTERWARDS SO A CRASH IN BETWEEN CAN'T LOSE ANY TASKS
+        with appendWrite(self.archiveFile()) as f:
+            with gzip.GzipFile(fileobj=f, mode='ab') as archive:
+                for root in toArchive:
+                    for task in itertools.chain([root], root.descendants()):
+                        if not task.archived:
+                            archive.write(json.dumps(task.asDict()) + '\n')
+        removedTasks = self.removeTasks(toArchive)
+        self.arrangeTasks()
+        return removedTasks
+
+    def iterArchive(self):
+        '''
+        Yield the archived tasks one by one in the order they were archived. Within a subtree parents come before
+        their subtasks, but a subtask that was archived on its own comes before its parent
+        '''
+        archiveFile = self.archiveFile()
+        if not (archiveFile and os.path.isfile(archiveFile)):
+            return
+        try:
+            with gzip.open(archiveFile, 'rb') as f:
+                for line in f:
+                    yield Task.fromDict(json.loads(line))
+        except (IOError, EOFError, ValueError, zlib.error) as e:
+            # AN ARCHIVE CUT SHORT BY A CRASH STILL GIVES UP EVERYTHING UP TO THE DAMAGE
+            print 'could not read all of the task archive %s: %s' % (archiveFile, e)
+
+    def openArchive(self):
+        '''Start paging in archived tasks from the beginning of the archive'''
+        self.closeArchive()
+        self.archiveReader = self.iterArchive()
+        self.archivedOrphans = {}
+
+    def hasMoreArchived(self):
+        return self.archiveReader is not None
+
+    def loadArchivePage(self, count):
+        '''
+        Add the next count archived tasks to the store and return the ones that were added.
+        Subtasks whose parent has not been paged in yet are held back until it is
+        '''
+        if self.archiveReader is None:
+            return []
+        page = list(itertools.islice(self.archiveReader, count))
+        if len(page) < count:
+            # ALL ARCHIVED TASKS ARE IN
+            self.archiveReader = None
+
+        added = []
+        for task in page:
+            if task.id in self.archiveRemovals or self.taskWithId(task.id) is not None:
+                # RESTORED OR DELETED ALREADY, OR STILL IN THE TASKS FILE AS WELL AFTER A CRASH
+                continue
+            task.archived = True
+            if task.pendingParentId:
+                parent = self.taskWithId(task.pendingParentId)
+                if parent is None:
+                    self.archivedOrphans.setdefault(task.pendingParentId, []).append(task)
+                    continue
+                parent.addChild(task)
+            self.addArchivedTask(task, added)
+
+        if self.archiveReader is None:
+            # SUBTASKS WHOSE PARENT NEVER SHOWED UP BECOME TOP LEVEL TASKS, TOGETHER WITH THE SUBTASKS HELD BACK FOR THEM
+            heldIds = set(task.id for orphans in self.archivedOrphans.values() for task in orphans)
+            for parentId in [parentId for parentId in self.archivedOrphans if parentId not in heldIds]:
+                for task in self.archivedOrphans.pop(parentId):
+                    task.pendingParentId = 0
+                    self.addArchivedTask(task, added)
+            self.archivedOrphans = {}
+        return added
+
+    def addArchivedTask(self, task, added):
+        '''Put a paged in archived task into the store, followed by the subtasks that were held back for it'''
+        self.tasks.append(task)
+        self.appendRank(task)
+        task.history = self.history
+        self.tasksById[task.id] = task
+        added.append(task)
+        for child in self.archivedOrphans.pop(task.id, []):
+            task.addChild(child)
+            self.addArchivedTask(child, added)
+
+    def closeArchive(self):
+        '''Stop paging in archived tasks and drop the ones that were paged in. Return the dropped tasks'''
+        self.archiveReader = None
+        self.archivedOrphans = {}
+        removedTasks = self.removeTasks([task for task in self.tasks if task.archived and not (task.parent and task.parent.archived)])
+        self.arrangeTasks()
+        self.flushArchive()
+        return removedTasks
+
+    def restoreTask(self, task):
+        '''Move an archived task back into the tasks file, together with its archived parents'''
+        for t in task.selfAndAncestors():
+            if t.archived:
+                t.archived = False
+                self.archiveRemovals.add(t.id)
+
+    def flushArchive(self):
+        '''Rewrite the archive file without the tasks that were restored or deleted since it was last written'''
+        archiveFile = self.archiveFile()
+        if not self.archiveRemovals or self.archiveReader is not None or not (archiveFile and os.path.isfile(archiveFile)):
+            # CAN'T REPLACE THE ARCHIVE WHILE IT IS BEING PAGED IN, TRY AGAIN WHEN IT IS CLOSED
+            return
+        kept = [task.asDict() for task in self.iterArchive() if task.id not in self.archiveRemovals]
+        with safeWrite(archiveFile) as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as archive:
+                for data in kept:
+                    archive.write(json.dumps(data) + '\n')
+        self.archiveRemovals = set()
 
     def loadTasks(self):
         '''Try to load tasks from disk. If no tasks have been saved return default data'''
     
+        self.lastId = 0
         if self.tasksFile and os.path.isfile(self.tasksFile):
-            tree = ET.parse(self.tasksFile)
-            root = tree.getroot()
-            taskElements = root.findall('Task')
-            if not taskElements:
+            reader = TaskReader(self.tasksFile, useSnapshot=TaskStore.USESNAPSHOT)
+            taskList = list(reader)
+            self.lastId = reader.lastId
+            if not taskList:
                 # NO TASKS WERE SAVED
-                return [Task()]
-
-            taskList = []
-            for te in taskElements:
-                task = Task(name=te.findtext('name'),
-                            priority=int(te.findtext('priority')),
-                            status=int(te.findtext('status')))
-                taskList.append(task)
+                taskList = [Task(taskId=self.newTaskId())]
         else:
             # NO SETTINGS FILE FOUND
-            taskList = [Task()]
+            taskList = [Task(taskId=self.newTaskId())]
         
         self.tasks = taskList
+        self.linkAll()
 
-    def resetTasks(self):
-        '''Assign an index from 1..n to all tasks in the store'''
+    def linkAll(self):
+        '''Hook up all loaded tasks with their parents, tasks with a missing parent become top level tasks'''
 
-        for i, task in enumerate(self.tasks):
-            task.index = i
-    def filterFinished(self, hideFinished):
-        '''Hide finished tasks by assigning a negative index'''
-        
+        self.tasksById = dict((task.id, task) for task in self.tasks)
+        self.linkTasks(self.tasks)
+        for orphans in self.orphans.values():
+            for task in orphans:
+                task.pendingParentId = 0
+        self.orphans = {}
+
+    def saveHistory(self):
+        '''Append the status and priority changes made since the last save to the history file'''
+
+        try:
+            self.history.save()
+        except (IOError, OSError) as e:
+            print 'could not write task history:', e
+
+    def statusReport(self):
+        '''Return a table of how long every task has spent waiting, in progress and finished, worked out from its history'''
+
+        totals = self.history.timeInStatus()
+        lines = ['%-40s %12s %12s %12s' % ('task', 'waiting h', 'progress h', 'finished h')]
+        for task in self.treeOrder():
+            if task.id not in totals:
+                continue
+            lines.append('%-40s %12.1f %12.1f %12.1f' % tuple([('  ' * task.depth() + task.name)[:40]] + [seconds / 3600.0 for seconds in totals[task.id]]))
+        return '\n'.join(lines)
+
+    def saveSnapshot(self):
+        '''Write a binary snapshot of all tasks next to the tasks file for a faster start next time'''
+
+        if not TaskStore.USESNAPSHOT or not (self.tasksFile and os.path.isfile(self.tasksFile)):
+            return
+        try:
+            TaskSnapshot.write(snapshotPathFromSettings(self.tasksFile), self.savedTasks(), self.lastId, self.tasksFile)
+        except (IOError, OSError, struct.error) as e:
+            # THE SNAPSHOT IS ONLY A CACHE, IT MUST NEVER BREAK SAVING THE TASKS
+            print 'could not write task snapshot:', e
+
+    def arrangeTasks(self, hideFinished=None, sortActive=None):
+        '''
+        Work out the row (index) of every task from scratch. Finished tasks are hidden if hideFinished is True, siblings are
+        sorted by the highest priority found in their subtree, highest first if sortActive is True, and subtasks follow
+        their parent. Hidden tasks and subtasks of collapsed tasks get an index of -1.
+        Leaving out an argument keeps the current choice
+        '''
+        if hideFinished is not None:
+            self.hideFinished = hideFinished
+        if sortActive is not None:
+            self.sortActive = sortActive
         for task in self.tasks:
-            if hideFinished and task.status == 2:
-                task.index = -1
-                
-    def sortByPriority(self, active):
-        '''Sort tasks by their priority by assigning a corresponding index'''
-        sortedTasks = sorted([t for t in self.tasks if t.index >= 0], key=lambda task: task.priority)
-        if active:
-            # sort highest first
-            sortedTasks.reverse()
+            task.index = -1
+            task.placedKey = None
+        # SORT KEYS AND TASKS OF THE SHOWN CHILDREN OF EVERY SHOWN, EXPANDED TASK (AND OF THE TOP LEVEL UNDER None)
+        self.shownChildren = {}
+        self.rows = self.subTreeRows(None)
+        self.movedRows = {}
+        self.numberRows(0, len(self.rows))
+        # EVERY ROW WAS NUMBERED FROM SCRATCH, THERE IS NO POINT HOLDING ON TO ALL OF THEM
+        self.movedRows = {}
+
+    def sortKey(self, task):
+        priority = task.rollupPriority()
+        if self.sortActive:
+            # HIGHEST FIRST, TASKS WITH THE SAME PRIORITY IN REVERSE ORDER
+            return (-priority, -task.rank)
+        return (priority, task.rank)
+
+    def isFiltered(self, task):
+        # ARCHIVED TASKS ARE ONLY IN THE STORE BECAUSE SOMEBODY ASKED TO SEE THEM
+        return self.hideFinished and task.rollupStatus() == 2 and not task.archived
+
+    def subTreeRows(self, task):
+        '''Return task followed by all its shown subtasks in the order they are shown. With task None return all shown tasks'''
+        rows = [task] if task else []
+        if task is None or task.expanded:
+            children = self.rootTasks() if task is None else task.children
+            shown = sorted((self.sortKey(child), child) for child in children if not self.isFiltered(child))
+            self.shownChildren[task] = ([key for key, child in shown], [child for key, child in shown])
+            for key, child in shown:
+                child.placedKey = key
+                rows.extend(self.subTreeRows(child))
+        return rows
+
+    def numberRows(self, start, end):
+        for i in range(start, end):
+            task = self.rows[i]
+            if task.index != i:
+                self.movedRows.setdefault(task, task.index)
+                task.index = i
+
+    def nextRow(self, task):
+        '''Return the task in the row right after the rows of task and its shown subtasks, None if they are the last rows'''
+        while task:
+            keys, siblings = self.shownChildren[task.parent]
+            i = bisect.bisect_right(keys, task.placedKey)
+            if i < len(siblings):
+                return siblings[i]
+            task = task.parent
+        return None
+
+    def takeRows(self, task):
+        '''
+        Take the rows of task and its shown subtasks out, they keep their order among themselves.
+        Return the index of the first row, the index after the last and the rows
+        '''
+        nextTask = self.nextRow(task)
+        start, end = task.index, nextTask.index if nextTask else len(self.rows)
+        block = self.rows[start:end]
+        del self.rows[start:end]
+        keys, siblings = self.shownChildren[task.parent]
+        i = bisect.bisect_left(keys, task.placedKey)
+        del keys[i]
+        del siblings[i]
+        return start, end, block
+
+    def forgetRows(self, block):
+        '''Mark the tasks in block as not shown'''
+        for t in block:
+            self.movedRows.setdefault(t, t.index)
+            t.index = -1
+            t.placedKey = None
+            self.shownChildren.pop(t, None)
+
+    def rearrangeTask(self, task, rebuild=False):
+        '''
+        Move the rows of task, which was just added or had its priority or status changed, and of its ancestors, whose rollups
+        changed with it, to where they belong now. Only the rows in between the old and new places get a new index.
+        With rebuild the rows of the subtasks of task are worked out again as well, e.g. after it was expanded or collapsed.
+        Return the tasks whose index changed
+        '''
+        self.movedRows = {}
+        for t in reversed(list(task.selfAndAncestors())):
+            self.placeTask(t, rebuild and t is task)
+        return self.takeMovedRows()
+
+    def takeMovedRows(self):
+        '''Return the tasks whose index changed since movedRows was last emptied, rows that ended up where they were don't count'''
+        moved = set(task for task, oldIndex in self.movedRows.iteritems() if task.index != oldIndex)
+        self.movedRows = {}
+        return moved
+
+    def placeTask(self, task, rebuild=False):
+        '''Move the rows of task and its shown subtasks to where they belong among its siblings, show or hide them'''
+        parent = task.parent
+        shown = not self.isFiltered(task) and (parent is None or (parent.expanded and parent.index >= 0))
+        key = self.sortKey(task) if shown else None
+        if not rebuild and key == task.placedKey and shown == (task.index >= 0):
+            # STILL IN THE RIGHT PLACE
+            return
+
+        start = None
+        if task.index >= 0:
+            start, end, block = self.takeRows(task)
+            if rebuild or not shown:
+                self.forgetRows(block)
+        if not shown:
+            if start is not None:
+                self.numberRows(start, len(self.rows))
+            return
+        if rebuild or start is None:
+            block = self.subTreeRows(task)
+        # OTHERWISE THE SUBTASKS MOVE ALONG IN THE ORDER THEY WERE IN
+
+        keys, siblings = self.shownChildren[parent]
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+        siblings.insert(i, task)
+        task.placedKey = key
+        nextTask = self.nextRow(task)
+        if nextTask is None:
+            position = len(self.rows)
+        else:
+            position = nextTask.index
+            if start is not None and position >= end:
+                # INDEX FROM BEFORE THE OLD ROWS WERE TAKEN OUT
+                position -= end - start
+        self.rows[position:position] = block
+
+        if start is None or len(block) != end - start:
+            # ROWS BELOW MOVE UP OR DOWN
+            self.numberRows(min(start, position) if start is not None else position, len(self.rows))
+        else:
+            self.numberRows(min(start, position), max(end, position + len(block)))
+
+
+class TaskLoader(QtCore.QThread):
+    '''Worker thread that reads the tasks file and hands the tasks to the GUI in chunks'''
+    CHUNKSIZE = 200
+    tasksLoaded = QtCore.Signal(object)
+    loadingFinished = QtCore.Signal(int)
+    loadingFailed = QtCore.Signal(str)
+
+    def __init__(self, tasksFile, parent=None):
+        super(TaskLoader, self).__init__(parent)
+        self.tasksFile = tasksFile
+        self.cancelled = False
+
+    def cancel(self):
+        '''Stop loading as soon as possible. No more signals are sent after this'''
+        self.cancelled = True
+
+    def run(self):
+        reader = TaskReader(self.tasksFile, useSnapshot=TaskStore.USESNAPSHOT)
+        chunk = []
+        try:
+            for task in reader:
+                if self.cancelled:
+                    return
+                chunk.append(task)
+                if len(chunk) == TaskLoader.CHUNKSIZE:
+                    self.tasksLoaded.emit(chunk)
+                    chunk = []
+        except Exception as e:
+            # A BROKEN FILE MUST NOT LEAVE THE PANEL WAITING FOR THE REST OF ITS TASKS FOREVER
+            if not self.cancelled:
+                self.tasksLoaded.emit(chunk)
+                self.loadingFailed.emit('%s: %s' % (type(e).__name__, e))
+            return
+        if self.cancelled:
+            return
+        if chunk:
+            self.tasksLoaded.emit(chunk)
+        self.loadingFinished.emit(reader.lastId)
+
 
-        for i, task in enumerate([t for t in sortedTasks if t.index >= 0]):
-            task.index = i
+########## INSTRUMENTATION #######################################################################
+class FrameProfiler(QtCore.QObject):
+    '''
+    Opt-in instrumentation to measure how smooth the panel feels. Records:
+       stalls - event loop hiccups longer than STALLTHRESHOLD
+       paint times - number of calls and time spent in paintEvent per widget class
+       dropped frames - gaps between animation updates that are longer than a frame
+    Switch it on by setting the TODOLIST_PROFILE environment variable before the panel is created.
+    A summary is printed when the panel is closed.
+    '''
+    ENABLED = bool(os.environ.get('TODOLIST_PROFILE'))
+    STALLTHRESHOLD = .05
+    HEARTBEAT = 10
+    FRAMEINTERVAL = 1 / 60.0
+    active = None
+
+    def __init__(self, parent=None):
+        super(FrameProfiler, self).__init__(parent)
+        self.stalls = []
+        self.paintTimes = {}
+        self.animationFrames = 0
+        self.droppedFrames = 0
+        self.startTime = self.lastHeartbeat = time.time()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(FrameProfiler.HEARTBEAT)
+        self.timer.timeout.connect(self.heartbeat)
+
+    def start(self):
+        FrameProfiler.active = self
+        self.startTime = self.lastHeartbeat = time.time()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        if FrameProfiler.active is self:
+            FrameProfiler.active = None
+
+    def heartbeat(self):
+        '''Fires every HEARTBEAT ms while the event loop is responsive, anything much later is a stall'''
+        now = time.time()
+        late = now - self.lastHeartbeat - FrameProfiler.HEARTBEAT / 1000.0
+        if late > FrameProfiler.STALLTHRESHOLD:
+            self.stalls.append(late)
+        self.lastHeartbeat = now
+
+    def recordPaint(self, className, duration):
+        calls, total, longest = self.paintTimes.get(className, (0, 0.0, 0.0))
+        self.paintTimes[className] = (calls + 1, total + duration, max(longest, duration))
+
+    def watchAnimation(self, animation):
+        '''Count the frames of animation and the ones it had to skip'''
+        lastTick = [None]
+
+        def tick(value):
+            now = time.time()
+            if lastTick[0] is not None:
+                gap = now - lastTick[0]
+                if gap > 1.5 * FrameProfiler.FRAMEINTERVAL:
+                    self.droppedFrames += int(gap / FrameProfiler.FRAMEINTERVAL) - 1
+            lastTick[0] = now
+            self.animationFrames += 1
+
+        animation.valueChanged.connect(tick)
+
+    def report(self):
+        '''Return a human readable summary of everything recorded so far'''
+        lines = ['ToDoList frame profile (%.1fs)' % (time.time() - self.startTime)]
+        if self.stalls:
+            lines.append('event loop stalls > %dms: %s (worst %.0fms, total %.0fms)' % (FrameProfiler.STALLTHRESHOLD * 1000,
+                                                                                      len(self.stalls),
+                                                                                      max(self.stalls) * 1000,
+                                                                                      sum(self.stalls) * 1000))
+        else:
+            lines.append('event loop stalls > %dms: 0' % (FrameProfiler.STALLTHRESHOLD * 1000))
+        totalFrames = self.animationFrames + self.droppedFrames
+        lines.append('animation frames: %s, dropped: %s (%.1f%%)' % (self.animationFrames,
+                                                                    self.droppedFrames,
+                                                                    100.0 * self.droppedFrames / totalFrames if totalFrames else 0))
+        lines.append('paint times per widget class:')
+        for className, (calls, total, longest) in sorted(self.paintTimes.iteritems(), key=lambda item: -item[1][1]):
+            lines.append('   %-20s calls %7d   total %8.1fms   avg %6.2fms   max %6.2fms' % (className,
+                                                                                         calls,
+                                                                                         total * 1000,
+                                                                                         total * 1000 / calls,
+                                                                                         longest * 1000))
+        return '\n'.join(lines)
+
+
+def profiledPaint(paintEvent):
+    '''Decorator for paintEvent methods to report their duration to the active FrameProfiler'''
+    @functools.wraps(paintEvent)
+    def wrapper(self, event):
+        profiler = FrameProfiler.active
+        if profiler is None:
+            return paintEvent(self, event)
+        start = time.time()
+        try:
+            return paintEvent(self, event)
+        finally:
+            profiler.recordPaint(type(self).__name__, time.time() - start)
+    return wrapper
 
 
 ########## VIEW CLASSES ###########################################################################
@@ -130,6 +1388,7 @@ class DragIndicator(QtGui.QWidget):
     def sizeHint(self):
         return QtCore.QSize(self.parentWidget().width(), self.parentWidget().height()/6)
    
+    @profiledPaint
     def paintEvent(self, event):
         '''Paint the button grey if not highlighted, else yellow'''
 
@@ -150,17 +1409,32 @@ class TaskWidget(QtGui.QWidget):
     TASKWIDGETWIDTH = 400
     TASKWIDGETHEIGHT = 40
     TASKWIDGETSPACING = 1.05
+    SUBTASKINDENT = 20
     newTaskSignal = QtCore.Signal()
+    newSubTaskSignal = QtCore.Signal()
+    nameChanged = QtCore.Signal(str)
+    nameEditingFinished = QtCore.Signal()
+    priorityChanged = QtCore.Signal(int)
+    allowSorting = QtCore.Signal()
+    statusChanged = QtCore.Signal(int)
+    deleteRequested = QtCore.Signal()
+    expandToggled = QtCore.Signal()
 
     def __init__(self, task, parent=None):
         super(TaskWidget, self).__init__(parent)
         self.task = task
+        # WHERE THE LAST ANIMATION IS TAKING THE WIDGET
+        self.targetPosition = None
+        self.moveAnimation = None
         self.setupUi()
 
     def setupUi(self):
         self.setAutoFillBackground(True)
         hLayout = QtGui.QHBoxLayout(self)
         self.setLayout(hLayout)
+        self.defaultMargins = hLayout.contentsMargins()
+        self.indent()
+        self.expandWidget = ExpandWidget(self.task)
         self.taskNameWidget = QtGui.QLineEdit(self.task.name)
         self.priorityWidget = PriorityWidget()
         self.priorityWidget.setValue(self.task.priority)
@@ -168,11 +1442,44 @@ class TaskWidget(QtGui.QWidget):
         self.statusWidget.setCurrentIndex(self.task.status)
         self.deleteWidget = DeleteWidget('delete')
 
+        hLayout.addWidget(self.expandWidget)
         hLayout.addWidget(self.taskNameWidget)
         hLayout.addWidget(self.priorityWidget)
         hLayout.addWidget(self.statusWidget)
         hLayout.addWidget(self.deleteWidget)
 
+        # PASS THE CHILD WIDGETS' SIGNALS ON AS THE ROW'S OWN
+        self.taskNameWidget.textChanged.connect(self.nameChanged)
+        self.taskNameWidget.editingFinished.connect(self.nameEditingFinished)
+        self.priorityWidget.valueChanged.connect(self.priorityChanged)
+        self.priorityWidget.allowSorting.connect(self.allowSorting)
+        self.statusWidget.currentIndexChanged.connect(self.statusChanged)
+        self.deleteWidget.clicked.connect(self.deleteRequested)
+        self.expandWidget.clicked.connect(self.expandToggled)
+
+    def indent(self):
+        '''Shift the contents to the right according to how deep the task sits in the tree'''
+        margins = self.defaultMargins
+        self.layout().setContentsMargins(margins.left() + self.task.depth() * TaskWidget.SUBTASKINDENT, margins.top(), margins.right(), margins.bottom())
+
+    def refresh(self):
+        '''Show the task's current values after it was changed from outside the widget, without sending any signals'''
+        self.blockSignals(True)
+        try:
+            if self.taskNameWidget.text() != self.task.name:
+                self.taskNameWidget.setText(self.task.name)
+            self.priorityWidget.setValue(self.task.priority)
+            self.statusWidget.setCurrentIndex(self.task.status)
+        finally:
+            self.blockSignals(False)
+        self.indent()
+        self.update()
+
+    def editName(self):
+        '''Put the keyboard focus on the task name with all of it selected'''
+        self.taskNameWidget.setSelection(0, len(self.taskNameWidget.text()))
+        self.taskNameWidget.setFocus(QtCore.Qt.FocusReason.ActiveWindowFocusReason)
+
     def update(self):
         '''Resize this widget to use full width'''
         super(TaskWidget, self).update()
@@ -196,15 +1503,68 @@ class TaskWidget(QtGui.QWidget):
 
         return QtCore.QPoint(x, y)
     def keyPressEvent(self, event):
-        '''send newTaskSignal if shit+return is pressed'''
+        '''send newTaskSignal if shit+return is pressed, newSubTaskSignal if ctrl+return is pressed'''
         
         if event.key() == QtCore.Qt.Key_Return and (event.modifiers() & QtCore.Qt.ShiftModifier):
             print 'doing stuff'
             self.newTaskSignal.emit()
+        elif event.key() == QtCore.Qt.Key_Return and (event.modifiers() & QtCore.Qt.ControlModifier):
+            self.newSubTaskSignal.emit()
         else:
             super(TaskWidget, self).keyPressEvent(event)
 
+class ExpandWidget(QtGui.QPushButton):
+    '''Arrow to show or hide the subtasks of a task together with the number of finished subtasks'''
+    TOOLTIP = '<b>subtasks</b><br>click to show/hide subtasks<br>ctrl+return to add a subtask'
+
+    def __init__(self, task, parent=None):
+        super(ExpandWidget, self).__init__(parent)
+        self.task = task
+        self.size = QtCore.QSize(40, 20)
+        self.setSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        self.setToolTip(ExpandWidget.TOOLTIP)
+        self.color = QtGui.QColor(247, 147, 30, 255)
+        self.font = QtGui.QFont('Helvetica', 8)
+
+    @profiledPaint
+    def paintEvent(self, event):
+        if not self.task.children:
+            return
+
+        painter = QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        ExpandWidget.paintExpander(painter, self.rect(), self.task, self.color, self.font)
+
+    @staticmethod
+    def paintExpander(painter, rect, task, color, font):
+        '''Paint an arrow pointing right when collapsed and down when expanded, followed by the finished/total subtask count'''
+        painter.setPen(QtCore.Qt.transparent)
+        painter.setBrush(color)
+        arrow = QtGui.QPolygon()
+        if task.expanded:
+            arrow << QtCore.QPoint(2, 6) << QtCore.QPoint(12, 6) << QtCore.QPoint(7, 14)
+        else:
+            arrow << QtCore.QPoint(4, 4) << QtCore.QPoint(12, 10) << QtCore.QPoint(4, 16)
+        arrow.translate(rect.x(), rect.y() + (rect.height() - 20) / 2)
+        painter.drawPolygon(arrow)
+
+        painter.setPen(color)
+        painter.setFont(font)
+        textRect = QtCore.QRect(rect.x() + 14, rect.y(), rect.width() - 14, rect.height())
+        painter.drawText(textRect, QtCore.Qt.AlignCenter, '%s/%s' % (task.finishedSubTaskCount(), task.subTaskCount()))
+
+    def sizeHint(self):
+        return self.size
+
+    def minimumSizeHint(self):
+        return self.size
+
+    def maximumSizeHint(self):
+        return self.size
+
+
 class PriorityWidget(QtGui.QLabel):
+    TOOLTIP = '<b>priority</b><br>use either:<ul><li>LMB to increase  -  RMB to decrease</li><li>alt+LMB drag to change value</li><li>MMB drag to change value</li></ul><i>move mouse away after changing value<br>to trigger re-sorting</i>'
     valueChanged = QtCore.Signal(int)
     allowSorting = QtCore.Signal()
 
@@ -212,7 +1572,7 @@ class PriorityWidget(QtGui.QLabel):
         super(PriorityWidget, self).__init__(parent)
         self.color = QtGui.QColor(247, 147, 30, 255)
         self.font = QtGui.QFont('Helvetica', 12, QtGui.QFont.Bold)
-        self.setToolTip('<b>priority</b><br>use either:<ul><li>LMB to increase  -  RMB to decrease</li><li>alt+LMB drag to change value</li><li>MMB drag to change value</li></ul><i>move mouse away after changing value<br>to trigger re-sorting</i>')
+        self.setToolTip(PriorityWidget.TOOLTIP)
         self.active = False
         self.mouseOver = False
         self.value = 0
@@ -230,6 +1590,7 @@ class PriorityWidget(QtGui.QLabel):
         self.valueChanged.emit(self.value)
         self.update()
 
+    @profiledPaint
     def paintEvent(self, event):
         '''Paint the custom look'''
 
@@ -315,6 +1676,7 @@ class StatusWidgetPie(QtGui.QComboBox):
     def maximumSizeHint(self):
         return self.size 
 
+    @profiledPaint
     def paintEvent(self, event):
         painter = QtGui.QPainter(self)
         painter.setRenderHint(QtGui.QPainter.Antialiasing)
@@ -341,15 +1703,19 @@ class StatusWidgetPie(QtGui.QComboBox):
             painter.drawPie(pieRect, startAngle, spanAngle)
 
 class StatusWidgetBar(QtGui.QComboBox):
+    TOOLTIP = '<b>status</b><br>click to edit'
+    STATUSLABELS = ['waiting', 'in progress', 'finished']
+
     def __init__(self, parent=None):
         super(StatusWidgetBar, self).__init__(parent)
-        self.setToolTip('<b>status</b><br>click to edit')
-        self.addItems(['waiting', 'in progress', 'finished'])
+        self.setToolTip(StatusWidgetBar.TOOLTIP)
+        self.addItems(StatusWidgetBar.STATUSLABELS)
         self.active = False
         self.colWaiting = QtGui.QColor(180, 100, 10)
         self.colInProgress = QtGui.QColor(255, 140, 30)
         self.colFinished = QtGui.QColor('darkGreen')
     
+    @profiledPaint
     def paintEvent(self, event):
         painter = QtGui.QPainter(self)
         painter.setRenderHint(QtGui.QPainter.Antialiasing)
@@ -396,16 +1762,19 @@ class StatusWidgetBar(QtGui.QComboBox):
         
 
 class DeleteWidget(QtGui.QPushButton):
+    TOOLTIP = 'permanently delete this task'
+
     def __init__(self, parent=None):
         super(DeleteWidget, self).__init__(parent)
         self.size = QtCore.QSize(20, 20)
         self.setSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
-        self.setToolTip('permanently delete this task')
+        self.setToolTip(DeleteWidget.TOOLTIP)
         self.padding = 7
         self.active = False
         self.inactiveColor = QtGui.QColor(180, 50, 0)
         self.activeColor = self.inactiveColor.lighter()
 
+    @profiledPaint
     def paintEvent(self, event):
         painter = QtGui.QPainter(self)
         painter.setRenderHint(QtGui.QPainter.Antialiasing)
@@ -444,10 +1813,339 @@ class DeleteWidget(QtGui.QPushButton):
         return self.size 
 
 
+class LightTaskWidget(TaskWidget):
+    '''
+    Flyweight version of TaskWidget that paints name, priority, status and delete button itself instead of using child widgets.
+    Fonts, colours and tooltips are shared by all rows and a line edit is only created while the name is being edited.
+    Emits the same signals as TaskWidget.
+    '''
+    MARGIN = 9
+    SPACING = 6
+    EXPANDWIDTH = 40
+    PRIORITYWIDTH = 50
+    STATUSWIDTH = 100
+    DELETESIZE = 20
+    DELETEPADDING = 7
+    # THE FIELDS TAB MOVES THROUGH, IN THE ORDER OF THE CHILD WIDGETS OF A TASKWIDGET
+    FOCUSFIELDS = ['name', 'priority', 'status', 'delete']
+    # SHARED STYLES, CREATED WITH THE FIRST ROW
+    nameFont = None
+    priorityFont = None
+    expandFont = None
+    priorityColor = None
+    statusColors = None
+    deleteColor = None
+    outlineColor = None
+    indicatorBrush = None
+
+    def setupUi(self):
+        if LightTaskWidget.priorityFont is None:
+            LightTaskWidget.setupStyles()
+        self.setAutoFillBackground(True)
+        self.setMouseTracking(True)
+        self.setFocusPolicy(QtCore.Qt.StrongFocus)
+        self.priority = self.task.priority
+        self.status = self.task.status
+        self.editor = None
+        self.hoverField = None
+        self.focusField = None
+        self.pressedField = None
+        self.allowDrag = False
+
+    @classmethod
+    def setupStyles(cls):
+        cls.nameFont = QtGui.QFont()
+        cls.priorityFont = QtGui.QFont('Helvetica', 12, QtGui.QFont.Bold)
+        cls.expandFont = QtGui.QFont('Helvetica', 8)
+        cls.priorityColor = QtGui.QColor(247, 147, 30, 255)
+        cls.statusColors = [QtGui.QColor(180, 100, 10), QtGui.QColor(255, 140, 30), QtGui.QColor('darkGreen')]
+        cls.deleteColor = QtGui.QColor(180, 50, 0)
+        cls.outlineColor = QtGui.QColor(0, 0, 0, 255)
+        gradient = QtGui.QLinearGradient(QtCore.QPoint(0, 0), QtCore.QPoint(cls.PRIORITYWIDTH / 2, 0))
+        gradient.setColorAt(0, QtCore.Qt.transparent)
+        gradient.setColorAt(1, QtGui.QColor(247, 147, 30, 150))
+        gradient.setSpread(QtGui.QGradient.ReflectSpread)
+        cls.indicatorBrush = QtGui.QBrush(gradient)
+
+    def fieldRects(self):
+        '''Return the areas of the painted fields, laid out like the child widgets of a TaskWidget'''
+        top = LightTaskWidget.MARGIN
+        height = self.height() - 2 * LightTaskWidget.MARGIN
+        left = LightTaskWidget.MARGIN + self.task.depth() * TaskWidget.SUBTASKINDENT
+        right = self.width() - LightTaskWidget.MARGIN
+
+        expand = QtCore.QRect(left, top, LightTaskWidget.EXPANDWIDTH, height)
+        delete = QtCore.QRect(right - LightTaskWidget.DELETESIZE, top + (height - LightTaskWidget.DELETESIZE) / 2,
+                              LightTaskWidget.DELETESIZE, LightTaskWidget.DELETESIZE)
+        status = QtCore.QRect(delete.left() - LightTaskWidget.SPACING - LightTaskWidget.STATUSWIDTH, top,
+                              LightTaskWidget.STATUSWIDTH, height)
+        priority = QtCore.QRect(status.left() - LightTaskWidget.SPACING - LightTaskWidget.PRIORITYWIDTH, top,
+                                LightTaskWidget.PRIORITYWIDTH, height)
+        nameLeft = expand.right() + LightTaskWidget.SPACING
+        name = QtCore.QRect(nameLeft, top, priority.left() - LightTaskWidget.SPACING - nameLeft, height)
+        return {'expand': expand, 'name': name, 'priority': priority, 'status': status, 'delete': delete}
+
+    def fieldAt(self, pos):
+        for field, rect in self.fieldRects().iteritems():
+            if rect.contains(pos):
+                return field
+        return None
+
+    @profiledPaint
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        rects = self.fieldRects()
+
+        if self.task.children:
+            ExpandWidget.paintExpander(painter, rects['expand'], self.task, LightTaskWidget.priorityColor, LightTaskWidget.expandFont)
+
+        if not self.editor:
+            # NAME, DRAWN LIKE AN IDLE LINE EDIT
+            nameRect = rects['name']
+            painter.setPen(self.palette().color(QtGui.QPalette.Mid))
+            painter.setBrush(self.palette().base())
+            painter.drawRect(nameRect)
+            painter.setPen(self.palette().color(QtGui.QPalette.Text))
+            painter.setFont(LightTaskWidget.nameFont)
+            textRect = nameRect.adjusted(4, 0, -4, 0)
+            name = painter.fontMetrics().elidedText(self.task.name, QtCore.Qt.ElideRight, textRect.width())
+            painter.drawText(textRect, QtCore.Qt.AlignVCenter | QtCore.Qt.AlignLeft, name)
+
+        # PRIORITY
+        priorityRect = rects['priority']
+        if self.hoverField == 'priority':
+            # DRAG INDICATOR - MOVE THE PAINTER SO THE SHARED GRADIENT LINES UP WITH THE FIELD
+            indicatorHeight = priorityRect.height() / 6
+            painter.save()
+            painter.translate(priorityRect.left(), priorityRect.bottom() - indicatorHeight)
+            painter.setPen(QtCore.Qt.transparent)
+            painter.setBrush(LightTaskWidget.indicatorBrush)
+            painter.drawRect(QtCore.QRect(0, 0, priorityRect.width(), indicatorHeight))
+            painter.restore()
+        if self.focusField == 'priority' and self.hoverField != 'priority':
+            # WHEN KEYBOARD HAS SHIFTED FOCUS ONTO THE PRIORITY
+            painter.setPen(LightTaskWidget.priorityColor.lighter())
+        else:
+            painter.setPen(LightTaskWidget.priorityColor)
+        painter.setFont(LightTaskWidget.priorityFont)
+        painter.drawText(priorityRect, QtCore.Qt.AlignCenter, str(self.priority))
+
+        # STATUS BAR
+        statusRect = rects['status']
+        progress = (.1, .6, 1)[self.status]
+        color = LightTaskWidget.statusColors[self.status]
+        painter.setPen(QtCore.Qt.transparent)
+        painter.setBrush(color.lighter() if 'status' in (self.hoverField, self.focusField) else color)
+        barTop = statusRect.top() + statusRect.height() / 4
+        painter.drawRect(QtCore.QRect(statusRect.left(), barTop, int(statusRect.width() * progress), statusRect.height() / 2))
+        painter.setBrush(QtCore.Qt.transparent)
+        painter.setPen(LightTaskWidget.outlineColor)
+        painter.drawRect(QtCore.QRect(statusRect.left() + 1, barTop, statusRect.width() - 2, statusRect.height() / 2))
+
+        # DELETE CROSS
+        deleteRect = rects['delete'].adjusted(LightTaskWidget.DELETEPADDING, LightTaskWidget.DELETEPADDING + 1,
+                                              -LightTaskWidget.DELETEPADDING, -LightTaskWidget.DELETEPADDING + 1)
+        pen = QtGui.QPen(LightTaskWidget.deleteColor.lighter() if 'delete' in (self.hoverField, self.focusField) else LightTaskWidget.deleteColor)
+        pen.setWidth(3)
+        pen.setCapStyle(QtCore.Qt.PenCapStyle.RoundCap)
+        painter.setPen(pen)
+        painter.drawLine(deleteRect.topLeft(), deleteRect.bottomRight())
+        painter.drawLine(deleteRect.bottomLeft(), deleteRect.topRight())
+
+    def event(self, event):
+        '''Show the tooltip of the field under the mouse'''
+        if event.type() == QtCore.QEvent.ToolTip:
+            toolTip = {'expand': ExpandWidget.TOOLTIP if self.task.children else None,
+                       'priority': PriorityWidget.TOOLTIP,
+                       'status': StatusWidgetBar.TOOLTIP,
+                       'delete': DeleteWidget.TOOLTIP}.get(self.fieldAt(event.pos()))
+            if toolTip:
+                QtGui.QToolTip.showText(event.globalPos(), toolTip, self)
+            else:
+                QtGui.QToolTip.hideText()
+                event.ignore()
+            return True
+        return super(LightTaskWidget, self).event(event)
+
+    def editName(self):
+        '''Put a line edit over the painted name to edit it'''
+        if not self.editor:
+            self.editor = QtGui.QLineEdit(self.task.name, self)
+            self.editor.setGeometry(self.fieldRects()['name'])
+            self.editor.textChanged.connect(self.nameChanged)
+            self.editor.editingFinished.connect(self.finishEditing)
+            self.editor.show()
+        self.editor.selectAll()
+        self.editor.setFocus(QtCore.Qt.FocusReason.ActiveWindowFocusReason)
+
+    def finishEditing(self):
+        '''Get rid of the line edit again once the name is done'''
+        if not self.editor:
+            return
+        self.editor.deleteLater()
+        self.editor = None
+        if self.focusField == 'name' and not self.hasFocus():
+            self.focusField = None
+        self.update()
+        self.nameEditingFinished.emit()
+
+    def refresh(self):
+        '''Show the task's current values after it was changed from outside the widget, without sending any signals'''
+        self.priority = self.task.priority
+        self.status = self.task.status
+        if self.editor:
+            self.editor.setGeometry(self.fieldRects()['name'])
+        self.update()
+
+    def setPriority(self, priority):
+        self.priority = priority
+        self.priorityChanged.emit(priority)
+        self.update()
+
+    def setStatus(self, status):
+        if status == self.status:
+            return
+        self.status = status
+        self.update()
+        self.statusChanged.emit(status)
+
+    def showStatusMenu(self):
+        '''Pop up the status choices where the combo box of a TaskWidget would open'''
+        menu = QtGui.QMenu(self)
+        actions = [menu.addAction(label) for label in StatusWidgetBar.STATUSLABELS]
+        chosen = menu.exec_(self.mapToGlobal(self.fieldRects()['status'].bottomLeft()))
+        if chosen:
+            self.setStatus(actions.index(chosen))
+
+    def setFocusField(self, field):
+        '''Move the keyboard focus to one of the painted fields, the name gets its line edit'''
+        if self.focusField == 'priority' and field != 'priority':
+            # TABBING AWAY FROM THE PRIORITY TRIGGERS RE-SORTING, JUST LIKE FOR THE PRIORITY WIDGET
+            self.allowSorting.emit()
+        self.focusField = field
+        if field == 'name':
+            self.editName()
+        elif self.editor and field is not None:
+            # TAKE THE FOCUS BACK FROM THE LINE EDIT, WHICH FINISHES THE EDIT
+            self.setFocus(QtCore.Qt.OtherFocusReason)
+        self.update()
+
+    def focusInEvent(self, event):
+        '''Tabbing onto the row starts at its first field, tabbing backwards at its last one'''
+        if event.reason() == QtCore.Qt.TabFocusReason:
+            self.setFocusField(LightTaskWidget.FOCUSFIELDS[0])
+        elif event.reason() == QtCore.Qt.BacktabFocusReason:
+            self.setFocusField(LightTaskWidget.FOCUSFIELDS[-1])
+        super(LightTaskWidget, self).focusInEvent(event)
+
+    def focusOutEvent(self, event):
+        if event.reason() not in (QtCore.Qt.PopupFocusReason, QtCore.Qt.ActiveWindowFocusReason) and\
+           not (self.editor and self.editor.hasFocus()):
+            # FOCUS LEFT THE ROW, NOT JUST FOR THE LINE EDIT, THE STATUS MENU OR ANOTHER WINDOW
+            self.setFocusField(None)
+        super(LightTaskWidget, self).focusOutEvent(event)
+
+    def focusNextPrevChild(self, next):
+        '''Let tab move through the fields of the row before it moves on to the next widget'''
+        if self.focusField in LightTaskWidget.FOCUSFIELDS:
+            i = LightTaskWidget.FOCUSFIELDS.index(self.focusField) + (1 if next else -1)
+            if 0 <= i < len(LightTaskWidget.FOCUSFIELDS):
+                self.setFocusField(LightTaskWidget.FOCUSFIELDS[i])
+                return True
+            if self.editor:
+                # MOVE ON FROM THE ROW ITSELF, THE LINE EDIT SITS AT THE END OF THE TAB CHAIN
+                self.setFocus(QtCore.Qt.OtherFocusReason)
+        return super(LightTaskWidget, self).focusNextPrevChild(next)
+
+    def keyPressEvent(self, event):
+        '''Arrow keys change priority and status, space opens the status menu or deletes, like the child widgets of a TaskWidget'''
+        key = event.key()
+        if self.focusField == 'priority' and key in (QtCore.Qt.Key_Left, QtCore.Qt.Key_Down):
+            self.setPriority(self.priority - 1)
+        elif self.focusField == 'priority' and key in (QtCore.Qt.Key_Right, QtCore.Qt.Key_Up):
+            self.setPriority(self.priority + 1)
+        elif self.focusField == 'status' and key in (QtCore.Qt.Key_Left, QtCore.Qt.Key_Up):
+            self.setStatus(max(0, self.status - 1))
+        elif self.focusField == 'status' and key in (QtCore.Qt.Key_Right, QtCore.Qt.Key_Down):
+            self.setStatus(min(len(StatusWidgetBar.STATUSLABELS) - 1, self.status + 1))
+        elif self.focusField == 'status' and key == QtCore.Qt.Key_Space:
+            self.showStatusMenu()
+        elif self.focusField == 'delete' and key == QtCore.Qt.Key_Space:
+            self.deleteRequested.emit()
+        else:
+            super(LightTaskWidget, self).keyPressEvent(event)
+
+    def mousePressEvent(self, event):
+        field = self.fieldAt(event.pos())
+        self.pressedField = field
+        if field in LightTaskWidget.FOCUSFIELDS:
+            # A CLICKED FIELD TAKES THE KEYBOARD FOCUS, THE NAME GETS ITS LINE EDIT
+            self.setFocusField(field)
+        if field == 'priority':
+            if ((event.modifiers() == QtCore.Qt.AltModifier) and (event.button() == QtCore.Qt.MouseButton.LeftButton)) or\
+               (event.button() == QtCore.Qt.MouseButton.MiddleButton):
+                self.allowDrag = True
+                self.clickPosition = event.pos()
+                self.oldValue = self.priority
+            elif event.button() == QtCore.Qt.MouseButton.LeftButton:
+                self.setPriority(self.priority + 1)
+            elif event.button() == QtCore.Qt.MouseButton.RightButton:
+                self.setPriority(self.priority - 1)
+        elif field == 'status':
+            self.showStatusMenu()
+        elif field != 'name':
+            super(LightTaskWidget, self).mousePressEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        self.allowDrag = False
+        field = self.fieldAt(event.pos())
+        if field == self.pressedField:
+            # BEHAVE LIKE BUTTONS AND ONLY REACT IF RELEASED OVER THE FIELD THAT WAS PRESSED
+            if field == 'delete':
+                self.deleteRequested.emit()
+            elif field == 'expand' and self.task.children:
+                self.expandToggled.emit()
+        self.pressedField = None
+
+    def mouseMoveEvent(self, event):
+        if self.allowDrag:
+            self.setPriority(self.oldValue + (event.pos().x() - self.clickPosition.x()) / 50)
+            return
+        self.setHoverField(self.fieldAt(event.pos()))
+
+    def leaveEvent(self, event):
+        self.setHoverField(None)
+
+    def setHoverField(self, field):
+        if field == self.hoverField:
+            return
+        if self.hoverField == 'priority':
+            # MOVING AWAY FROM THE PRIORITY TRIGGERS RE-SORTING, JUST LIKE FOR THE PRIORITY WIDGET
+            self.allowSorting.emit()
+        self.hoverField = field
+        self.update()
+
+    def resizeEvent(self, event):
+        if self.editor:
+            self.editor.setGeometry(self.fieldRects()['name'])
+        super(LightTaskWidget, self).resizeEvent(event)
+
+
 class MainWindow(QtGui.QWidget):
     '''GUI to show and edit multiple tasks'''
     appName = 'com.ohufx.ToDoList'
-    def __init__(self, parent=None):
+    RELOADDELAY = 300
+    # LET PIPELINE TOOLS TALK TO THE LIVE PANEL THROUGH A LOCAL SOCKET
+    ENABLESERVER = bool(os.environ.get('TODOLIST_SERVER'))
+    POLLINTERVAL = 2000
+    # PAINT EACH ROW AS A SINGLE WIDGET INSTEAD OF A LAYOUT OF CHILD WIDGETS - MUCH CHEAPER FOR LONG LISTS
+    LIGHTWEIGHTROWS = bool(os.environ.get('TODOLIST_LIGHTROWS'))
+    # TASKS THAT HAVE BEEN FINISHED FOR LONGER THAN THIS MOVE TO THE ARCHIVE, 0 TURNS ARCHIVING OFF. SAVED WITH THE PANEL SETTINGS
+    ARCHIVEAFTERDAYS = 30
+    ARCHIVEPAGESIZE = 100
+    def __init__(self, parent=None, settingsFile=None):
+        '''settingsFile is only used when running standalone, inside of Nuke the script decides where tasks are saved'''
         self._closeRunningInstances()
         super(MainWindow, self).__init__(parent)
 
@@ -457,12 +2155,26 @@ class MainWindow(QtGui.QWidget):
         self.inHiero = inHiero()
         self.animGroupsDeleted = [] # HOLD ANIMATIONS FOR DELETED WIDGETS - REQUIRED FOR OVERLAPPING DELETE ACTIONS
         self.settingsFile = ''
+        self.standaloneSettingsFile = settingsFile
         self.warningText = ''
+        self.taskLoader = None
+        self.savePending = False
+        # SET WHEN THE SETTINGS FILE COULDN'T BE READ, NOTHING IS SAVED OVER IT UNTIL IT IS FIXED
+        self.loadError = None
+        self.settingsFileStat = None
+        self.taskServer = None
+        self.archiveAfterDays = MainWindow.ARCHIVEAFTERDAYS
+        self.profiler = None
+        if FrameProfiler.ENABLED:
+            self.profiler = FrameProfiler(self)
+            self.profiler.start()
         self.setSettingsFile()
-        self.taskStore = TaskStore(self.settingsFile)
+        self.taskStore = TaskStore(self.settingsFile, load=False)
         self.setupUI()
+        self.setupFileWatcher()
         self.loadSettings()
         self.controller()
+        self.startLoading()
 
     def __str__(self):
         return 'OHUfx ToDoList Widget'
@@ -487,18 +2199,29 @@ class MainWindow(QtGui.QWidget):
         self.hideButton = QtGui.QPushButton('Hide Finished Tasks')
         self.hideButton.setCheckable(True)
         self.hideButton.setToolTip('Hide finished tasks to keep the list tidy')      
+        self.archiveButton = QtGui.QPushButton('Show Archived')
+        self.archiveButton.setCheckable(True)
+        self.archiveButton.setToolTip('Show tasks that were finished a long time ago and moved to the archive')
         self.clipboardButton = QtGui.QPushButton('Copy To Clipboard')
         self.clipboardButton.setToolTip('Push to copy current task info to cliboard for pasting into emails or other text documents.\nHandy to keep those coordinators happy.')
         
         self.buttonLayout.addWidget(self.addTaskButton)
         self.buttonLayout.addWidget(self.sortButton)
         self.buttonLayout.addWidget(self.hideButton)
+        self.buttonLayout.addWidget(self.archiveButton)
         self.buttonLayout.addWidget(self.clipboardButton)
         self.buttonLayout.addSpacing(20)
         self.buttonLayout.addWidget(self.helpButton)
         
+        self.loadingLabel = QtGui.QLabel()
+        self.loadingLabel.setHidden(True)
+        self.moreArchivedButton = QtGui.QPushButton('Show More Archived Tasks')
+        self.moreArchivedButton.setHidden(True)
+
         self.layout().addWidget(self.msg)
         self.layout().addLayout(self.buttonLayout)
+        self.layout().addWidget(self.loadingLabel)
+        self.layout().addWidget(self.moreArchivedButton)
        
         self.taskContainer = QtGui.QWidget()
         self.scrollArea = QtGui.QScrollArea()
@@ -522,36 +2245,300 @@ class MainWindow(QtGui.QWidget):
         self.layout().addWidget(self.scrollArea)
         ## END OF NAUGHTY CODE
 
-        self.taskWidgets = [TaskWidget(t, self.taskContainer) for t in self.taskStore.tasks]
+        # SUBTASKS OF COLLAPSED TASKS DON'T GET A WIDGET UNTIL THEIR PARENT IS EXPANDED
+        self.taskWidgets = [self.taskWidgetClass()(t, self.taskContainer) for t in self.taskStore.tasks if t.isShownInTree()]
+        self.taskWidgetsByTask = dict((tw.task, tw) for tw in self.taskWidgets)
+        # WIDGETS THAT HAVEN'T BEEN PUT IN THEIR PLACE YET
+        self.newTaskWidgets = []
         self.update()
 
     def rebuildTaskWidgets(self):
         '''Reset all task data, get settings file and re-build task widgets accordingly'''
 
+        # STOP LOADING TASKS FROM THE PREVIOUS SETTINGS FILE
+        self.stopLoading()
+
         # DELETE OLD TASK WIDGETS AND CLEAR INTERNAL LIST
         for oldWidget in self.taskWidgets:
             oldWidget.deleteLater()
         self.taskWidgets = []
+        self.taskWidgetsByTask = {}
+        self.newTaskWidgets = []
         
+
         # GET NEW SETTINGS FILE
         self.setSettingsFile()
         
         # RE-INIT TASK STORE WITH NEW TASK SETTINGS
-        self.taskStore.initStore(self.settingsFile)
+        self.taskStore.closeArchive()
+        self.taskStore.saveHistory()
+        self.taskStore.initStore(self.settingsFile, load=False)
+        self.archiveButton.setChecked(False)
+        self.moreArchivedButton.setHidden(True)
 
         # LOAD PANEL SETTINGS
         self.loadSettings()
 
-        # CREATE NEW TASK WIDGETS AND CONNECT THEIR SIGNALS
+        # CREATE NEW TASK CONTAINER, TASK WIDGETS ARE ADDED AS THE TASKS COME IN
         self.createTaskWidgets()
-
-        for tw in self.taskWidgets:
-            self.connectTaskWidgetSignals(tw)
         
         self.setEnabledState()
+        self.startLoading()
         self.applyFilterAndSorting()
         self.update()
 
+    def setupFileWatcher(self):
+        '''Keep an eye on the settings file so changes made by other tools or artists show up in the panel'''
+
+        self.fileWatcher = QtCore.QFileSystemWatcher(self)
+        # WAIT FOR WRITES TO SETTLE BEFORE READING THE FILE
+        self.reloadTimer = QtCore.QTimer(self)
+        self.reloadTimer.setSingleShot(True)
+        self.reloadTimer.setInterval(MainWindow.RELOADDELAY)
+        # FILE SYSTEM EVENTS DON'T ALWAYS MAKE IT ACROSS NETWORK SHARES, SO ALSO CHECK THE FILE EVERY NOW AND THEN
+        self.pollTimer = QtCore.QTimer(self)
+        self.pollTimer.setInterval(MainWindow.POLLINTERVAL)
+
+        self.fileWatcher.fileChanged.connect(self.reloadTimer.start)
+        self.reloadTimer.timeout.connect(self.applyExternalChanges)
+        self.pollTimer.timeout.connect(self.checkSettingsFile)
+        self.pollTimer.start()
+
+    def watchSettingsFile(self):
+        '''Make sure the current settings file is watched. Needed again after every save, which replaces the file'''
+
+        watchedFiles = self.fileWatcher.files()
+        if self.settingsFile and os.path.isfile(self.settingsFile):
+            if self.settingsFile not in watchedFiles:
+                self.fileWatcher.addPath(self.settingsFile)
+        elif watchedFiles:
+            self.fileWatcher.removePaths(watchedFiles)
+
+    def checkSettingsFile(self):
+        '''Cheap check whether the settings file changed since it was last read or written'''
+
+        if self.settingsFile and fileStat(self.settingsFile) != self.settingsFileStat:
+            self.reloadTimer.start()
+
+    def applyExternalChanges(self):
+        '''Read the settings file after it was changed by someone else and only update the tasks and widgets that differ'''
+
+        self.watchSettingsFile()
+        if self.isLoading():
+            # TRY AGAIN ONCE ALL TASKS ARE IN
+            self.reloadTimer.start()
+            return
+        stat = fileStat(self.settingsFile) if self.settingsFile else None
+        if stat is None or stat == self.settingsFileStat:
+            # GONE OR OUR OWN SAVE
+            return
+        self.settingsFileStat = stat
+
+        if self.loadError:
+            # MAYBE SOMEBODY FIXED IT - START OVER
+            print 'settings file changed on disk, reading it again:', self.settingsFile
+            self.rebuildTaskWidgets()
+            return
+        print 'settings file changed on disk, updating tasks from', self.settingsFile
+        reader = TaskReader(self.settingsFile)
+        try:
+            newTasks = list(reader)
+        except Exception as e:
+            # PROBABLY CAUGHT HALF WRITTEN BY A TOOL THAT DOESN'T REPLACE IT IN ONE GO, THE NEXT CHANGE WILL TRIGGER ANOTHER TRY
+            print 'could not read the changed settings file %s: %s' % (self.settingsFile, e)
+            return
+        added, changed, deleted = self.taskStore.applyChanges(newTasks, reader.lastId)
+        if added or changed or deleted:
+            self.updateViewForChanges(added, changed, deleted)
+
+    def updateViewForChanges(self, added, changed, deleted):
+        '''Refresh, create or drop only the task widgets affected by tasks that were changed outside of them'''
+
+        widgets = self.taskWidgetsByTask
+        for task in changed:
+            if task in widgets:
+                widgets[task].refresh()
+        for task in added + changed:
+            if task.isShownInTree():
+                if task not in widgets:
+                    widgets[task] = self.addTaskWidget(task)
+                    self.connectTaskWidgetSignals(widgets[task])
+                self.addSubTaskWidgets(task, widgets[task].pos())
+                if not task.expanded:
+                    self.removeSubTaskWidgets(task)
+            else:
+                self.removeTaskWidgets(set([task]))
+                self.removeSubTaskWidgets(task)
+
+        # DELETED TASKS HAVE AN INDEX OF -2 NOW, SO THEIR WIDGETS DROP OUT OF VIEW
+        self.applyFilterAndSorting()
+        self.dropDeletedTaskWidgets()
+
+    def startServer(self):
+        '''(Re-)start the local server for the current settings file if it is enabled'''
+
+        self.stopServer()
+        if not (MainWindow.ENABLESERVER and self.settingsFile):
+            return
+        self.taskServer = TaskServer(self)
+        if not self.taskServer.listen(serverNameFromSettings(self.settingsFile)):
+            self.taskServer = None
+
+    def stopServer(self):
+        if self.taskServer is not None:
+            self.taskServer.close()
+            self.taskServer.deleteLater()
+            self.taskServer = None
+
+    def startLoading(self):
+        '''Load the tasks for the current settings file in a worker thread and add them to the view as they arrive'''
+
+        self.cancelLoading()
+        self.loadError = None
+        self.startServer()
+        # CHANGES MADE TO THE FILE FROM HERE ON ARE PICKED UP ONCE LOADING IS DONE
+        self.settingsFileStat = fileStat(self.settingsFile) if self.settingsFile else None
+        self.watchSettingsFile()
+        if not (self.settingsFile and os.path.isfile(self.settingsFile)):
+            # NOTHING TO READ - JUST PUT IN THE DEFAULT TASK
+            self.onLoadingFinished(0)
+            return
+
+        self.loadingLabel.setText('<i>loading tasks...</i>')
+        self.loadingLabel.setHidden(False)
+        self.taskLoader = TaskLoader(self.settingsFile, self)
+        self.taskLoader.tasksLoaded.connect(self.onTasksLoaded)
+        self.taskLoader.loadingFinished.connect(self.onLoadingFinished)
+        self.taskLoader.loadingFailed.connect(self.onLoadingFailed)
+        self.taskLoader.start()
+
+    def cancelLoading(self):
+        '''Stop a running task loader. Chunks it already queued up are ignored'''
+
+        if self.taskLoader is None:
+            return
+        self.taskLoader.cancel()
+        self.taskLoader.wait()
+        self.taskLoader.deleteLater()
+        self.taskLoader = None
+        self.loadingLabel.setHidden(True)
+
+    def stopLoading(self):
+        '''
+        Stop loading before the panel closes or moves on to another settings file. If tasks were edited while loading,
+        the rest of the file is read first so the edits can be saved, otherwise they would be lost
+        '''
+
+        if self.taskLoader is not None and self.savePending:
+            self.taskLoader.wait()
+            # HAND THE CHUNKS THE LOADER QUEUED UP TO onTasksLoaded AND FINISH LOADING, WHICH SAVES
+            QtCore.QCoreApplication.sendPostedEvents(self, 0)
+        self.cancelLoading()
+        self.savePending = False
+
+    def isLoading(self):
+        return self.taskStore.loading
+
+    def onTasksLoaded(self, tasks):
+        '''Add a chunk of tasks delivered by the task loader to the store and the view'''
+
+        if self.sender() is not self.taskLoader:
+            # LEFT OVER FROM A CANCELLED LOADER
+            return
+        for task in self.taskStore.appendTasks(tasks):
+            if task.isShownInTree():
+                self.connectTaskWidgetSignals(self.addTaskWidget(task))
+        self.loadingLabel.setText('<i>loading tasks... (%s)</i>' % len(self.taskStore.tasks))
+        self.applyFilterAndSorting()
+
+    def onLoadingFinished(self, lastId):
+        '''All tasks are in, hand over to the user and write out any changes made while loading'''
+
+        if self.taskLoader is not None:
+            if self.sender() is not self.taskLoader:
+                return
+            self.taskLoader.deleteLater()
+            self.taskLoader = None
+        self.loadingLabel.setHidden(True)
+
+        for task in self.taskStore.finishLoading(lastId):
+            if task.isShownInTree():
+                self.connectTaskWidgetSignals(self.addTaskWidget(task))
+        self.applyFilterAndSorting()
+        self.archiveFinishedTasks()
+
+        if self.savePending or self.taskStore.finishedTimesAdded:
+            # ALSO SAVE THE FINISH TIMES THAT WERE MADE UP FOR OLDER FILES, OR THEIR TASKS NEVER GET OLD ENOUGH TO BE ARCHIVED
+            self.savePending = False
+            self.saveSettingsAndTasks()
+
+        if self.taskServer:
+            self.taskServer.processPending()
+
+    def onLoadingFailed(self, error):
+        '''
+        The settings file could not be read completely. Keep the tasks that were read, but don't save over the file
+        (which would lose the rest of its tasks) until it has been fixed and read again
+        '''
+
+        if self.sender() is not self.taskLoader:
+            return
+        print 'could not read all tasks from %s: %s' % (self.settingsFile, error)
+        # SET BEFORE FINISHING SO NEITHER PENDING EDITS NOR THE ARCHIVE GET SAVED OVER THE FILE
+        self.loadError = error
+        self.savePending = False
+        self.onLoadingFinished(self.taskStore.lastId)
+        self.loadingLabel.setText('<b>Could not read all tasks from %s (%s). Changes will not be saved until the file is fixed.</b>'
+                                  % (escape(self.settingsFile), escape(error)))
+        self.loadingLabel.setHidden(False)
+
+    def archiveFinishedTasks(self):
+        '''Move tasks that were finished a long time ago out of the tasks file and the view into the archive'''
+
+        if not (self.settingsFile and self.archiveAfterDays > 0):
+            return
+        if self.loadError:
+            # THE TASKS FILE WON'T BE REWRITTEN, SO THE SAME TASKS WOULD BE ARCHIVED AGAIN WITH EVERY LOAD
+            return
+        try:
+            archived = self.taskStore.archiveFinished(self.archiveAfterDays * 24 * 3600)
+        except (IOError, OSError) as e:
+            print 'could not archive finished tasks:', e
+            return
+        if archived:
+            print 'moved %s finished tasks to %s' % (len(archived), self.taskStore.archiveFile())
+            self.applyFilterAndSorting()
+            self.dropDeletedTaskWidgets()
+            self.saveSettingsAndTasks()
+
+    def onShowArchived(self):
+        '''Page in the first archived tasks, or drop all archived tasks from the view again'''
+
+        if self.archiveButton.isChecked():
+            self.taskStore.openArchive()
+            self.onMoreArchived()
+        else:
+            self.taskStore.closeArchive()
+            self.moreArchivedButton.setHidden(True)
+            self.applyFilterAndSorting()
+            self.dropDeletedTaskWidgets()
+
+    def onMoreArchived(self):
+        '''Page in the next archived tasks'''
+
+        for task in self.taskStore.loadArchivePage(MainWindow.ARCHIVEPAGESIZE):
+            if task.isShownInTree():
+                self.connectTaskWidgetSignals(self.addTaskWidget(task))
+        self.moreArchivedButton.setHidden(not self.taskStore.hasMoreArchived())
+        self.applyFilterAndSorting()
+
+    def restoreArchivedTask(self):
+        '''Edits to an archived task bring it back into the tasks file'''
+
+        task = self.sender().task
+        if task.archived:
+            self.taskStore.restoreTask(task)
+
     def setSettingsFile(self):
         '''get the path to the xml file to read/write settings'''
         if self.inNuke:
@@ -575,71 +2562,146 @@ class MainWindow(QtGui.QWidget):
             if hieroSetup():
                 self.settingsFile = [tag.metadata().value('tag.settingsFile') for tag in hiero.core.findProjectTags() if tag.name() == 'ohufx.ToDoList'][0]
         else:
-            self.settingsFile = None
+            self.settingsFile = self.standaloneSettingsFile
+
+    def taskWidgetClass(self):
+        '''Return the class used for the task rows'''
+        return LightTaskWidget if MainWindow.LIGHTWEIGHTROWS else TaskWidget
 
     def addTaskWidget(self, task):
         '''Add a new widget for task'''
 
-        newTaskWidget = TaskWidget(task, parent=self.taskContainer)
+        newTaskWidget = self.taskWidgetClass()(task, parent=self.taskContainer)
         newTaskWidget.show()
         self.taskWidgets.append(newTaskWidget)
+        self.taskWidgetsByTask[task] = newTaskWidget
+        self.newTaskWidgets.append(newTaskWidget)
         return newTaskWidget
 
+    def addSubTaskWidgets(self, task, position):
+        '''Add widgets for all subtasks of task that are shown in the tree, starting out at position'''
+
+        for subTask in task.descendants(expandedOnly=True):
+            if subTask not in self.taskWidgetsByTask:
+                newTaskWidget = self.addTaskWidget(subTask)
+                newTaskWidget.move(position)
+                self.connectTaskWidgetSignals(newTaskWidget)
+
+    def removeSubTaskWidgets(self, task):
+        '''Get rid of the widgets of all subtasks of task'''
+
+        self.removeTaskWidgets(set(task.descendants()))
+
+    def removeTaskWidgets(self, tasks):
+        '''Get rid of the widgets of tasks'''
+
+        for task in tasks:
+            taskWidget = self.taskWidgetsByTask.pop(task, None)
+            if taskWidget:
+                taskWidget.deleteLater()
+        self.taskWidgets = [taskWidget for taskWidget in self.taskWidgets if taskWidget.task not in tasks]
+        self.newTaskWidgets = [taskWidget for taskWidget in self.newTaskWidgets if taskWidget.task not in tasks]
+
+    def dropDeletedTaskWidgets(self):
+        '''Forget the widgets of deleted tasks, they are left to their animation out of view'''
+
+        for taskWidget in self.taskWidgets:
+            if taskWidget.task.index == -2:
+                self.taskWidgetsByTask.pop(taskWidget.task, None)
+        self.taskWidgets = [taskWidget for taskWidget in self.taskWidgets if taskWidget.task.index != -2]
+
     def deleteTask(self):
-        '''Delete a task'''
-        self.taskWidgetToDelete = self.sender().parent()
-        self.taskWidgets = [taskWidget for taskWidget in self.taskWidgets if self.taskWidgetToDelete != taskWidget]
+        '''Delete the sending task widget's task together with its subtasks and let their widgets drop out of view'''
+        self.taskWidgetToDelete = self.sender()
+        parent = self.taskWidgetToDelete.task.parent
+        movedTasks = self.taskStore.deleteTask(self.taskWidgetToDelete.task)
+        self.update(set(parent.selfAndAncestors()) if parent else set(), movedTasks)
+        self.dropDeletedTaskWidgets()
+        self.saveSettingsAndTasks()
 
     def deleteTaskWidget(self):
         '''remove deleted widgets to avoid surprises when rescaling the parent window'''
         sender = self.sender()
-        deletedWidget = sender.animationAt(0).targetObject()
-        deletedWidget.setParent(None)
+        for i in range(sender.animationCount()):
+            deletedWidget = sender.animationAt(i).targetObject()
+            deletedWidget.setParent(None)
         self.animGroupsDeleted.remove(sender) # JUST CLEANING UP, SHUOLDNT BE NECESSARY
 
     def loadSettings(self):
         '''Try to load sorting and filtering settings from disk. If nothing has been saved do nothing'''
 
-        if self.settingsFile and os.path.isfile(self.settingsFile):
-            print 'loading settings from', self.settingsFile
-            tree = ET.parse(self.settingsFile)
-            root = tree.getroot()
-            settings = root.find('Settings')
-            self.hideButton.setChecked(eval(settings.findtext('hideFinished')))
-            self.sortButton.setChecked(eval(settings.findtext('sortState')))
+        self.archiveAfterDays = MainWindow.ARCHIVEAFTERDAYS
+
+        settingsFile = self.panelSettingsFile()
+        if not (settingsFile and os.path.isfile(settingsFile)):
+            # PANELS SAVED BEFORE THE SETTINGS GOT THEIR OWN FILE ONLY HAVE THEM AT THE TOP OF THE TASKS FILE
+            settingsFile = self.settingsFile
+
+        if settingsFile and os.path.isfile(settingsFile):
+            print 'loading settings from', settingsFile
+            settings = readPanelSettings(settingsFile)
+            if not settings:
+                return
+            try:
+                self.hideButton.setChecked(parseBool(settings.get('hideFinished')))
+                self.sortButton.setChecked(parseBool(settings.get('sortState')))
+            except ValueError as e:
+                print 'ignoring invalid panel settings in %s: %s' % (settingsFile, e)
+            try:
+                if settings.get('archiveAfterDays') is not None:
+                    self.archiveAfterDays = float(settings['archiveAfterDays'])
+            except ValueError as e:
+                print 'ignoring invalid archive age in %s: %s' % (settingsFile, e)
         else:
             pass
 
+    def panelSettingsFile(self):
+        '''Return the file holding the sorting and filtering choices, which sits next to the settings file'''
+        return panelSettingsPathFromSettings(self.settingsFile) if self.settingsFile else None
+
+    def panelSettings(self):
+        '''Return the current sorting and filtering choices as name/value pairs'''
+        return [('hideFinished', self.hideButton.isChecked()),
+                ('sortState', self.sortButton.isChecked()),
+                ('archiveAfterDays', self.archiveAfterDays)]
+
+    def savePanelSettings(self):
+        '''Dump current sorting and filtering choices to their own small file, leaving the tasks untouched'''
+        if not self.settingsFile:
+            print 'no settings file found, nothing will be saved'
+            return
+        # SAME FORMAT AS THE SETTINGS FILE, JUST WITHOUT ANY TASKS
+        writeTasksFile(self.panelSettingsFile(), self.panelSettings(), [])
+
     def saveSettingsAndTasks(self):
-        '''Dump current sorting and filtering choices to disk for reloading'''
+        '''Dump all tasks together with the current sorting and filtering choices to disk for reloading'''
         if not self.settingsFile:
             print 'no settings file found, nothing will be saved'
             return
+        if self.isLoading():
+            # DON'T OVERWRITE THE FILE WITH A HALF LOADED LIST, SAVE ONCE ALL TASKS ARE IN
+            self.savePending = True
+            return
+        if self.loadError:
+            print 'not saving over %s, it could not be read: %s' % (self.settingsFile, self.loadError)
+            return
         print 'saving task panel\'s settings to disk: %s' % self.settingsFile
-        settingsToBeSaved = {}
-        settingsToBeSaved['hideFinished'] = str(self.hideButton.isChecked())
-        settingsToBeSaved['sortState'] = str(self.sortButton.isChecked())
-
-        root = ET.Element('ToDoPanel')
-        settingsEle = ET.SubElement(root, 'Settings')
-        for k, v in settingsToBeSaved.iteritems():
-            settingEle = ET.SubElement(settingsEle, k)
-            settingEle.text = v
-        
-        for task in self.taskStore.tasks:
-            taskDict = task.__dict__
-            tasksEle = ET.SubElement(root, 'Task')
-            for k, v in taskDict.iteritems():
-                taskEle = ET.SubElement(tasksEle, k)
-                taskEle.text = str(v)
-
-        tree = ET.ElementTree(root)
-        tree.write(self.settingsFile)
+
+        # PARENTS ARE WRITTEN BEFORE THEIR SUBTASKS. THE PANEL SETTINGS LIVE IN THEIR OWN FILE NOW
+        # BUT ARE STILL WRITTEN HERE SO OLDER VERSIONS OF THE PANEL CAN READ THE FILE
+        writeTasksFile(self.settingsFile, self.panelSettings(), self.taskStore.savedTasks(), self.taskStore.lastId)
+        self.taskStore.markSaved()
+        # REMEMBER WHAT WE WROTE SO THE FILE WATCHER DOESN'T MISTAKE IT FOR SOMEONE ELSE'S CHANGE
+        self.settingsFileStat = fileStat(self.settingsFile)
+        self.watchSettingsFile()
+        self.taskStore.saveSnapshot()
+        self.taskStore.saveHistory()
+        # RESTORED TASKS ARE SAFE IN THE TASKS FILE NOW
+        self.taskStore.flushArchive()
               
     def copyToClipboard(self):
-        sortedTasks = sorted([t for t in self.taskStore.tasks if t.index >= 0], key=lambda task: task.priority)
-        if self.sortButton.isChecked():
-            sortedTasks.reverse()
+        # INDICES ALREADY REFLECT THE SORTING AND KEEP SUBTASKS WITH THEIR PARENTS
+        sortedTasks = sorted([t for t in self.taskStore.tasks if t.index >= 0], key=lambda task: task.index)
 
         clipboard = QtGui.QApplication.clipboard() 
         text = '\n'.join([str(t) for t in sortedTasks])
@@ -656,27 +2718,66 @@ class MainWindow(QtGui.QWidget):
         
         newTask = self.taskStore.addTask()
         newTaskWidget = self.addTaskWidget(newTask)
-        newTaskWidget.taskNameWidget.setSelection(0, len(newTaskWidget.taskNameWidget.text()))
-        newTaskWidget.taskNameWidget.setFocus(QtCore.Qt.FocusReason.ActiveWindowFocusReason)
+        newTaskWidget.editName()
         self.connectTaskWidgetSignals(newTaskWidget)
-        self.applyFilterAndSorting()
+        self.rearrangeTask(newTask)
+
+    def onAddSubTask(self):
+        '''Add a new subtask to the task of the sending task widget and expand it'''
+
+        parentWidget = self.sender()
+        if parentWidget.task.archived:
+            self.taskStore.restoreTask(parentWidget.task)
+        newTask = self.taskStore.addTask(parent=parentWidget.task)
+        # THE PARENT GETS EXPANDED, SO ITS OTHER SUBTASKS NEED WIDGETS AS WELL
+        self.addSubTaskWidgets(parentWidget.task, parentWidget.pos())
+        newTaskWidget = self.taskWidgetsByTask[newTask]
+        newTaskWidget.editName()
+        self.rearrangeTask(parentWidget.task, rebuild=True)
+
+    def onToggleExpanded(self):
+        '''Show or hide the subtasks of the sending task widget's task. Hidden subtasks don't keep any widgets'''
+
+        taskWidget = self.sender()
+        task = taskWidget.task
+        if not task.children:
+            return
+        task.expanded = not task.expanded
+        if task.expanded:
+            self.addSubTaskWidgets(task, taskWidget.pos())
+        else:
+            self.removeSubTaskWidgets(task)
+        self.rearrangeTask(task, rebuild=True)
+        self.saveSettingsAndTasks()
 
     def applyFilterAndSorting(self):
         '''Filter and sort all tasks according to their settings, the update the view accordingly'''
 
-        self.taskStore.resetTasks()
-        self.taskStore.filterFinished(self.hideButton.isChecked())
-        self.taskStore.sortByPriority(self.sortButton.isChecked())
-        self.update()       
+        self.taskStore.arrangeTasks(self.hideButton.isChecked(), self.sortButton.isChecked())
+        self.update()
+
+    def rearrangeTask(self, task, rebuild=False):
+        '''Only move the rows that need to after task was added, edited, expanded or collapsed'''
+
+        movedTasks = self.taskStore.rearrangeTask(task, rebuild)
+        # PARENTS SHOW THE ROLLUPS OF THEIR SUBTASKS
+        self.update(set(task.selfAndAncestors()), movedTasks)
+
+    def onTaskChanged(self):
+        '''Move the sending task widget's task to its new place after its priority or status changed'''
+
+        self.rearrangeTask(self.sender().task)
 
     def connectSignalsWithSlots(self):
         '''Connect the main window's widgets with their slots'''
         
         self.addTaskButton.clicked.connect(self.onAddTask)
         self.sortButton.clicked.connect(self.applyFilterAndSorting)
-        self.sortButton.clicked.connect(self.saveSettingsAndTasks)
+        self.sortButton.clicked.connect(self.savePanelSettings)
         self.hideButton.clicked.connect(self.applyFilterAndSorting)
-        self.hideButton.clicked.connect(self.saveSettingsAndTasks)
+        self.hideButton.clicked.connect(self.savePanelSettings)
+        self.archiveButton.clicked.connect(self.onShowArchived)
+        self.moreArchivedButton.clicked.connect(self.onMoreArchived)
         self.helpButton.clicked.connect(launchWebsite)
         self.clipboardButton.clicked.connect(self.copyToClipboard)
         for tw in self.taskWidgets:
@@ -685,22 +2786,35 @@ class MainWindow(QtGui.QWidget):
     def connectTaskWidgetSignals(self, taskWidget):
         '''Connect task widgets' signals with their slots'''
 
-        taskWidget.taskNameWidget.textChanged.connect(taskWidget.task.setName)
-        taskWidget.taskNameWidget.editingFinished.connect(self.saveSettingsAndTasks)
-        taskWidget.priorityWidget.valueChanged.connect(taskWidget.task.setPriority)
-        taskWidget.priorityWidget.valueChanged.connect(self.saveSettingsAndTasks)
-        taskWidget.priorityWidget.allowSorting.connect(self.applyFilterAndSorting)
-        taskWidget.statusWidget.currentIndexChanged.connect(taskWidget.task.setStatus)
-        taskWidget.statusWidget.currentIndexChanged.connect(self.applyFilterAndSorting)
-        taskWidget.statusWidget.currentIndexChanged.connect(self.saveSettingsAndTasks)
-        taskWidget.deleteWidget.clicked.connect(self.taskStore.deleteTask)
-        taskWidget.deleteWidget.clicked.connect(self.update)
-        taskWidget.deleteWidget.clicked.connect(self.deleteTask)
-        taskWidget.deleteWidget.clicked.connect(self.saveSettingsAndTasks)
+        taskWidget.nameChanged.connect(taskWidget.task.setName)
+        taskWidget.nameEditingFinished.connect(self.restoreArchivedTask)
+        taskWidget.nameEditingFinished.connect(self.saveSettingsAndTasks)
+        taskWidget.priorityChanged.connect(taskWidget.task.setPriority)
+        taskWidget.priorityChanged.connect(self.restoreArchivedTask)
+        taskWidget.priorityChanged.connect(self.saveSettingsAndTasks)
+        taskWidget.allowSorting.connect(self.onTaskChanged)
+        taskWidget.statusChanged.connect(taskWidget.task.setStatus)
+        taskWidget.statusChanged.connect(self.restoreArchivedTask)
+        taskWidget.statusChanged.connect(self.onTaskChanged)
+        taskWidget.statusChanged.connect(self.saveSettingsAndTasks)
+        taskWidget.deleteRequested.connect(self.deleteTask)
         taskWidget.newTaskSignal.connect(self.onAddTask)
+        taskWidget.newSubTaskSignal.connect(self.onAddSubTask)
+        taskWidget.expandToggled.connect(self.onToggleExpanded)
 
     def resizeEvent(self, event):
         self.update()
+
+    def closeEvent(self, event):
+        self.stopLoading()
+        self.stopServer()
+        # LETS THE ARCHIVE LOSE TASKS THAT WERE RESTORED WHILE IT WAS SHOWN
+        self.taskStore.closeArchive()
+        self.taskStore.saveHistory()
+        if self.profiler:
+            self.profiler.stop()
+            print self.profiler.report()
+        super(MainWindow, self).closeEvent(event)
         
     def showEvent(self, event):
         self.setEnabledState()
@@ -757,23 +2871,43 @@ class MainWindow(QtGui.QWidget):
                 pass
 
 
-    def update(self):
-        '''Animate the view to match sorting and filtering requests'''
-
+    def update(self, changedTasks=None, movedTasks=None):
+        '''
+        Animate the view to match sorting and filtering requests. Only widgets that have somewhere new to go are animated.
+        If changedTasks is given only the widgets of those tasks and the ones that move are repainted, otherwise all of them.
+        If movedTasks is given as well only the widgets of changed and moved tasks and new widgets are looked at
+        '''
 
-        self.deletedTaskWidgets = [tw for tw in self.taskWidgets if tw.task.index == -2]
+        if movedTasks is None:
+            taskWidgets = self.taskWidgets
+        else:
+            taskWidgets = set(self.newTaskWidgets)
+            taskWidgets.update(self.taskWidgetsByTask[task] for task in movedTasks | changedTasks if task in self.taskWidgetsByTask)
+        self.newTaskWidgets = []
         taskWidgetsHeight = len(self.taskWidgets) * (TaskWidget.TASKWIDGETHEIGHT * TaskWidget.TASKWIDGETSPACING)
         self.taskContainer.resize(self.scrollArea.width() - 20, max(taskWidgetsHeight, self.scrollArea.height()))
 
-        self.animGroup = QtCore.QParallelAnimationGroup()
         animGroupForDeletedWidget = QtCore.QParallelAnimationGroup()
         animGroupForDeletedWidget.finished.connect(self.deleteTaskWidget)
-
-        for taskWidget in self.taskWidgets:          
-            moveAnimation = QtCore.QPropertyAnimation(taskWidget, 'pos')
+        watchingAnimation = False
+
+        for taskWidget in taskWidgets:
+            newPosition = taskWidget.getNewPosition()
+            if newPosition == taskWidget.targetPosition:
+                # ALREADY THERE OR ON ITS WAY
+                if changedTasks is None or taskWidget.task in changedTasks:
+                    taskWidget.update()
+                continue
+            taskWidget.targetPosition = newPosition
+            if taskWidget.moveAnimation is not None:
+                # HEAD FOR THE NEW PLACE FROM WHEREVER THE LAST ANIMATION GOT TO
+                taskWidget.moveAnimation.stop()
+                taskWidget.moveAnimation.deleteLater()
+                taskWidget.moveAnimation = None
+            moveAnimation = QtCore.QPropertyAnimation(taskWidget, 'pos', taskWidget)
             moveAnimation.setDuration(1000)
             moveAnimation.setStartValue(taskWidget.pos())
-            moveAnimation.setEndValue(taskWidget.getNewPosition())           
+            moveAnimation.setEndValue(newPosition)
 
             if taskWidget.task.index == -2:
                 # DELETED WIDGET
@@ -781,11 +2915,15 @@ class MainWindow(QtGui.QWidget):
                 animGroupForDeletedWidget.addAnimation(moveAnimation)
             else:
                 moveAnimation.setEasingCurve(QtCore.QEasingCurve.OutCubic)
-                self.animGroup.addAnimation(moveAnimation)
+                if self.profiler and not watchingAnimation and moveAnimation.startValue() != moveAnimation.endValue():
+                    # ONE MOVING WIDGET IS ENOUGH TO COUNT THE FRAMES OF ALL OF THEM
+                    self.profiler.watchAnimation(moveAnimation)
+                    watchingAnimation = True
+                # EACH WIDGET MOVES ON ITS OWN, SO WIDGETS THAT STAY PUT DON'T INTERRUPT THE ONES STILL ON THEIR WAY
+                taskWidget.moveAnimation = moveAnimation
+                moveAnimation.start()
             taskWidget.update()
-        # GO
-        self.animGroup.start()
-        
+
         # OVERLAP ANIMNATION FOR DELETED WIDGETS IN CASE OF RAPID TASK DELETION
         if animGroupForDeletedWidget.animationCount():
             self.animGroupsDeleted.append(animGroupForDeletedWidget)
@@ -803,6 +2941,9 @@ class MainWindow(QtGui.QWidget):
         Use LMB and RMB to change priorities to sort the list accordingly.
         You can also use MMB+drag or alt+LMB drag to change a task's priority.
         </p>
+        <p>
+        Press ctrl+return in a task to give it a subtask and click the arrow next to a task to show or hide its subtasks.
+        </p>
         Change the status and hide finished tasks to keep an overview over your work load.
         <p>
         The "Copy To Clipboard" button puts a neatly formatted version of the current tasks into the clipboard for use in email or other text documents.
@@ -826,6 +2967,223 @@ class MainWindow(QtGui.QWidget):
                         p = p.parentWidget()
 
 
+########## IPC ###################################################################################
+class TaskServer(QtCore.QObject):
+    '''
+    Local socket server that gives pipeline tools access to the tasks of a running panel, instead of
+    editing the settings file behind its back. Clients send one json list of requests per line and get
+    one json list of responses back. Requests look like:
+        {"op": "query"}                                     - all tasks, optionally filtered by "ids", "status" or "parentId"
+        {"op": "add", "name": "roto", "parentId": 3}       - optional "name", "priority", "status", "parentId"
+        {"op": "update", "id": 4, "status": 2}             - any of "name", "priority", "status", "expanded"
+        {"op": "delete", "id": 4}                          - removes the task and its subtasks
+    Every response has "ok" and either the resulting data or an "error". Changes go through the panel's
+    normal view update and are saved once per batch. Use sendRequests() to talk to the server.
+    '''
+    FIELDTYPES = {'name': basestring, 'priority': int, 'status': int, 'expanded': bool}
+
+    def __init__(self, panel):
+        super(TaskServer, self).__init__(panel)
+        self.panel = panel
+        self.server = QtNetwork.QLocalServer(self)
+        self.server.newConnection.connect(self.onNewConnection)
+        self.buffers = {}
+        self.pending = []
+
+    # HOW LONG TO WAIT FOR ANOTHER PANEL TO ANSWER ON THE SAME NAME
+    PROBETIMEOUT = 500
+
+    def listen(self, name):
+        '''
+        Start listening on name, taking over a socket left behind by a panel that didn't shut down cleanly.
+        Return False if another running panel already serves the same settings file
+        '''
+        if not self.server.listen(name):
+            if self.isServed(name):
+                print 'another panel already serves %s, not starting the task server' % name
+                return False
+            QtNetwork.QLocalServer.removeServer(name)
+            if not self.server.listen(name):
+                print 'could not start the task server:', self.server.errorString()
+                return False
+        return True
+
+    def isServed(self, name):
+        '''Return True if a live server answers on name'''
+        socket = QtNetwork.QLocalSocket()
+        socket.connectToServer(name)
+        served = socket.waitForConnected(TaskServer.PROBETIMEOUT)
+        socket.abort()
+        return served
+
+    def close(self):
+        self.server.close()
+
+    def onNewConnection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.buffers[socket] = ''
+            socket.readyRead.connect(self.onReadyRead)
+            socket.disconnected.connect(self.onDisconnected)
+
+    def onDisconnected(self):
+        socket = self.sender()
+        self.buffers.pop(socket, None)
+        socket.deleteLater()
+
+    def onReadyRead(self):
+        socket = self.sender()
+        self.buffers[socket] += socket.readAll().data()
+        while '\n' in self.buffers[socket]:
+            line, self.buffers[socket] = self.buffers[socket].split('\n', 1)
+            if line.strip():
+                self.pending.append((socket, line))
+        self.processPending()
+
+    def processPending(self):
+        '''Answer all queued up requests, unless the panel is still loading its tasks'''
+        if self.panel.isLoading():
+            return
+        pending, self.pending = self.pending, []
+        for socket, line in pending:
+            if socket not in self.buffers:
+                # CLIENT WENT AWAY
+                continue
+            socket.write(json.dumps(self.processBatch(line)) + '\n')
+            socket.flush()
+
+    def processBatch(self, line):
+        '''Run all requests in line, then update the view and save once'''
+        try:
+            requests = json.loads(line)
+        except ValueError as e:
+            return [{'ok': False, 'error': 'invalid json: %s' % e}]
+        if isinstance(requests, dict):
+            requests = [requests]
+
+        self.added, self.changed, self.deleted = [], [], []
+        responses = []
+        for request in requests:
+            try:
+                if not isinstance(request, dict):
+                    raise ValueError('requests have to be objects')
+                op = request.get('op')
+                if op not in ('query', 'add', 'update', 'delete'):
+                    raise ValueError('unknown op: %r' % op)
+                responses.append(dict(ok=True, **getattr(self, op)(request)))
+            except (ValueError, TypeError) as e:
+                responses.append({'ok': False, 'error': str(e)})
+            except KeyError as e:
+                responses.append({'ok': False, 'error': 'missing %s' % e.args[0]})
+
+        if self.added or self.changed or self.deleted:
+            # TASKS THAT WERE ADDED OR CHANGED AND THEN DELETED IN THE SAME BATCH ONLY NEED TO GO
+            deleted = set(self.deleted)
+            added = [task for task in self.added if task not in deleted]
+            changed = [task for task in self.changed if task not in deleted]
+            self.panel.updateViewForChanges(added, changed, self.deleted)
+            self.panel.saveSettingsAndTasks()
+        return responses
+
+    def taskFromRequest(self, request):
+        task = self.panel.taskStore.taskWithId(request['id'])
+        if task is None:
+            raise ValueError('no task with id %r' % request['id'])
+        return task
+
+    def checkFields(self, request):
+        '''Raise TypeError or ValueError if any of the task fields given in request is invalid'''
+        for field, fieldType in TaskServer.FIELDTYPES.iteritems():
+            if field not in request:
+                continue
+            value = request[field]
+            if not isinstance(value, fieldType) or (fieldType is int and isinstance(value, bool)):
+                raise TypeError('%s has to be of type %s' % (field, fieldType.__name__))
+            if field == 'status' and value not in (0, 1, 2):
+                raise ValueError('status has to be 0, 1 or 2')
+            if field == 'priority' and not -2 ** 31 <= value < 2 ** 31:
+                # PRIORITIES ARE STORED AS 32 BIT INTEGERS IN THE SNAPSHOT AND THE HISTORY
+                raise ValueError('priority has to fit into 32 bits')
+
+    def setFields(self, task, request):
+        '''Apply the task fields given in request to task'''
+        self.checkFields(request)
+        if 'name' in request:
+            task.setName(request['name'])
+        if 'priority' in request:
+            task.setPriority(request['priority'])
+        if 'status' in request:
+            task.setStatus(request['status'])
+        if 'expanded' in request:
+            task.expanded = request['expanded']
+
+    def query(self, request):
+        tasks = self.panel.taskStore.treeOrder()
+        if 'ids' in request:
+            ids = set(request['ids'])
+            tasks = (task for task in tasks if task.id in ids)
+        if 'status' in request:
+            tasks = (task for task in tasks if task.status == request['status'])
+        if 'parentId' in request:
+            tasks = (task for task in tasks if task.parentId == request['parentId'])
+        return {'tasks': [task.asDict() for task in tasks]}
+
+    def add(self, request):
+        # NOTHING MAY BE ADDED TO THE STORE FOR A REQUEST THAT IS TURNED DOWN
+        self.checkFields(request)
+        parent = None
+        if request.get('parentId'):
+            parent = self.taskFromRequest({'id': request['parentId']})
+        wasExpanded = parent.expanded if parent else True
+        if parent and parent.archived:
+            self.panel.taskStore.restoreTask(parent)
+        task = self.panel.taskStore.addTask(parent=parent)
+        self.setFields(task, request)
+        self.added.append(task)
+        if not wasExpanded:
+            # ADDING A SUBTASK EXPANDS THE PARENT
+            self.changed.append(parent)
+        return {'task': task.asDict()}
+
+    def update(self, request):
+        task = self.taskFromRequest(request)
+        self.setFields(task, request)
+        if task.archived:
+            self.panel.taskStore.restoreTask(task)
+        self.changed.append(task)
+        return {'task': task.asDict()}
+
+    def delete(self, request):
+        task = self.taskFromRequest(request)
+        self.deleted.append(task)
+        self.deleted.extend(task.descendants())
+        self.panel.taskStore.deleteTask(task)
+        return {}
+
+
+def sendRequests(settingsFile, requests, timeout=5000):
+    '''
+    Send a list of requests to the panel serving settingsFile and return its list of responses.
+    Blocks until the answer is in, raises IOError if the panel can't be reached
+    '''
+    socket = QtNetwork.QLocalSocket()
+    socket.connectToServer(serverNameFromSettings(settingsFile))
+    if not socket.waitForConnected(timeout):
+        raise IOError('could not connect to the ToDoList panel: %s' % socket.errorString())
+    socket.write(json.dumps(requests) + '\n')
+    socket.flush()
+    data = ''
+    while not data.endswith('\n'):
+        if not socket.waitForReadyRead(timeout):
+            raise IOError('no answer from the ToDoList panel: %s' % socket.errorString())
+        data += socket.readAll().data()
+    socket.disconnectFromServer()
+    return json.loads(data)
+
+def serverNameFromSettings(settingsFile):
+    '''return the name of the local server of the panel that works on settingsFile'''
+    return 'ToDoList-%s' % hashlib.md5(os.path.abspath(settingsFile)).hexdigest()[:16]
+
 def launchWebsite():
     import webbrowser
     webbrowser.open('http://www.nukepedia.com/python/ui/todolist')
@@ -834,6 +3192,107 @@ def settingsPathFromProject(projectFile):
     '''return the path for the settings file based on projectFile'''
     return os.path.splitext(projectFile)[0] + '_toDoSettings.xml'
 
+def writeTasksFile(tasksFile, settings, tasks, lastId=0):
+    '''
+    Write settings (list of name/value pairs) and tasks to tasksFile one element at a time.
+    Only the fields in Task.SCHEMA are written and the old file is only replaced once the new one is complete.
+    lastId is the highest task id handed out so far, including archived tasks
+    '''
+    def element(tag, value):
+        return '<%s>%s</%s>' % (tag, escape(unicode(value)).encode('utf-8'), tag)
+
+    with safeWrite(tasksFile) as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<ToDoPanel version="%s" lastId="%s">\n' % (Task.SCHEMAVERSION, lastId))
+        f.write('<Settings>%s</Settings>\n' % ''.join(element(name, value) for name, value in settings))
+        for task in tasks:
+            f.write('<Task>%s</Task>\n' % ''.join(element(field, getattr(task, field)) for field, fieldType, default in Task.SCHEMA))
+        f.write('</ToDoPanel>\n')
+
+@contextlib.contextmanager
+def safeWrite(targetFile):
+    '''
+    Write a file via a temporary file in the same directory that is renamed into place when done.
+    If anything goes wrong the original file is left untouched
+    '''
+    fd, tmpFile = tempfile.mkstemp(prefix='.%s.' % os.path.basename(targetFile),
+                                   dir=os.path.dirname(os.path.abspath(targetFile)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            # THE DATA HAS TO BE ON DISK BEFORE THE RENAME IS, OR A CRASH CAN LEAVE AN EMPTY FILE BEHIND
+            f.flush()
+            os.fsync(f.fileno())
+        # KEEP THE PERMISSIONS OF THE OLD FILE (MKSTEMP ONLY MAKES IT READABLE FOR US), SO OTHERS CAN STILL READ THE LIST
+        if os.path.isfile(targetFile):
+            os.chmod(tmpFile, os.stat(targetFile).st_mode & 0777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpFile, 0666 & ~umask)
+    except:
+        os.remove(tmpFile)
+        raise
+
+    try:
+        os.rename(tmpFile, targetFile)
+    except OSError:
+        # WINDOWS WON'T RENAME ONTO AN EXISTING FILE
+        os.remove(targetFile)
+        os.rename(tmpFile, targetFile)
+
+@contextlib.contextmanager
+def appendWrite(targetFile):
+    '''
+    Append to a file in place. Only for files that are read back record by record and
+    can lose a half written record at the end, everything else goes through safeWrite
+    '''
+    with open(targetFile, 'ab') as f:
+        yield f
+
+def readPanelSettings(settingsFile):
+    '''
+    return the panel settings saved in settingsFile as a dictionary of strings.
+    Stops reading at the end of the Settings element, which is written before any tasks.
+    An empty or unreadable file has no settings
+    '''
+    try:
+        if not os.path.getsize(settingsFile):
+            return {}
+        with open(settingsFile, 'rb') as f:
+            for event, element in ET.iterparse(f):
+                if element.tag == 'Settings':
+                    return dict((child.tag, child.text) for child in element)
+                if element.tag == 'Task':
+                    break
+    except (IOError, OSError, ET.ParseError) as e:
+        print 'could not read the panel settings from %s: %s' % (settingsFile, e)
+    return {}
+
+def panelSettingsPathFromSettings(settingsFile):
+    '''return the path for the file holding the panel's sorting and filtering choices that sits next to settingsFile'''
+    return os.path.splitext(settingsFile)[0] + '_panel.xml'
+
+def fileStat(path):
+    '''return modification time and size of path, or None if it does not exist'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+def archivePathFromSettings(settingsFile):
+    '''return the path for the compressed archive of long finished tasks that sits next to settingsFile'''
+    return os.path.splitext(settingsFile)[0] + '_archive.jsonl.gz'
+
+def historyPathFromSettings(settingsFile):
+    '''return the path for the log of status and priority changes that sits next to settingsFile'''
+    return os.path.splitext(settingsFile)[0] + '_history.bin'
+
+def snapshotPathFromSettings(settingsFile):
+    '''return the path for the binary task snapshot that sits next to settingsFile'''
+    return os.path.splitext(settingsFile)[0] + '.snapshot'
+
 def inNuke():
     '''Return True if this is run from inside of Nuke, else return False'''
     return 'Nuke' in os.path.split(sys.executable)[0]
@@ -949,7 +3408,12 @@ if __name__ == '__main__':
     #### STANDALONE FOR DEBUGGING
     import sys
     app = QtGui.QApplication([])
-    p = MainWindow()
+    if len(sys.argv) > 2 and sys.argv[2] == '--report':
+        # PRINT HOW LONG THE TASKS IN THE GIVEN SETTINGS FILE HAVE SPENT IN EACH STATUS
+        print TaskStore(sys.argv[1]).statusReport()
+        sys.exit()
+    # OPTIONALLY PASS A SETTINGS FILE TO LOAD AND SAVE TASKS WHILE DEBUGGING
+    p = MainWindow(settingsFile=sys.argv[1] if len(sys.argv) > 1 else None)
     p.show()
     sys.exit(app.exec_())
     
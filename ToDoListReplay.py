@@ -0,0 +1,298 @@
+'''
+Replay interaction traces against the ToDoList panel to measure how it holds up with big lists.
+Runs the panel on Qt's offscreen platform, generates a task file of the requested size, replays
+a recorded or synthetic trace of user interactions and reports latency percentiles per interaction
+together with the number of files written to disk.
+
+    python ToDoListReplay.py --tasks 1000 --steps 300
+    python ToDoListReplay.py --tasks 1000 --steps 300 --save-trace trace.json
+    python ToDoListReplay.py --tasks 5000 --trace trace.json
+    python ToDoListReplay.py --tasks 5000 --trace trace.json --light
+
+A trace is a json list of steps, each one a dictionary with an "action" and its arguments:
+    {"action": "add"}
+    {"action": "rename", "row": 3, "name": "new name"}
+    {"action": "priorityDrag", "row": 3, "distance": 120}
+    {"action": "status", "row": 3, "status": 2}
+    {"action": "delete", "row": 3}
+    {"action": "toggleHide"}
+    {"action": "toggleSort"}
+Rows index the panel's task widgets and wrap around, so traces can be replayed against lists of any size.
+
+Qt 4 builds don't have an offscreen platform, run the harness through xvfb-run there.
+Set TODOLIST_PROFILE to get the panel's frame profile on top.
+'''
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from PySide import QtGui, QtCore, QtTest
+
+import ToDoList
+
+
+ACTIONS = ('add', 'rename', 'priorityDrag', 'status', 'delete', 'toggleHide', 'toggleSort')
+# RELATIVE FREQUENCY OF ACTIONS IN SYNTHETIC TRACES
+ACTIONWEIGHTS = {'add': 2, 'rename': 3, 'priorityDrag': 4, 'status': 4, 'delete': 1, 'toggleHide': 1, 'toggleSort': 1}
+
+
+class WriteCounter(object):
+    '''Count the files ToDoList writes to disk by wrapping its safeWrite and appendWrite helpers'''
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.safeWrite = ToDoList.safeWrite
+        self.appendWrite = ToDoList.appendWrite
+
+    def install(self):
+        ToDoList.safeWrite = self.countedSafeWrite
+        ToDoList.appendWrite = self.countedAppendWrite
+
+    def uninstall(self):
+        ToDoList.safeWrite = self.safeWrite
+        ToDoList.appendWrite = self.appendWrite
+
+    def countedSafeWrite(self, targetFile):
+        counter = self
+
+        class CountedWrite(object):
+            def __enter__(self):
+                self.context = counter.safeWrite(targetFile)
+                return self.context.__enter__()
+
+            def __exit__(self, *excInfo):
+                result = self.context.__exit__(*excInfo)
+                if excInfo[0] is None:
+                    counter.writes += 1
+                    counter.bytes += os.path.getsize(targetFile)
+                return result
+
+        return CountedWrite()
+
+    def countedAppendWrite(self, targetFile):
+        counter = self
+
+        class CountedAppend(object):
+            def __enter__(self):
+                # ONLY THE APPENDED BYTES ARE WRITTEN, NOT THE WHOLE FILE
+                self.sizeBefore = os.path.getsize(targetFile) if os.path.isfile(targetFile) else 0
+                self.context = counter.appendWrite(targetFile)
+                return self.context.__enter__()
+
+            def __exit__(self, *excInfo):
+                result = self.context.__exit__(*excInfo)
+                if excInfo[0] is None:
+                    counter.writes += 1
+                    counter.bytes += os.path.getsize(targetFile) - self.sizeBefore
+                return result
+
+        return CountedAppend()
+
+
+def generateTasksFile(tasksFile, taskCount, seed=0):
+    '''Write a task file with taskCount random tasks'''
+    rng = random.Random(seed)
+    tasks = [ToDoList.Task(name='generated task %s' % i,
+                           priority=rng.randint(-5, 10),
+                           status=rng.choice((0, 0, 1, 2)),
+                           taskId=i + 1) for i in range(taskCount)]
+    ToDoList.writeTasksFile(tasksFile, [('hideFinished', False), ('sortState', False)], tasks)
+
+
+def syntheticTrace(steps, seed=0):
+    '''Return a random trace of steps interactions'''
+    rng = random.Random(seed)
+    weighted = [action for action in ACTIONS for i in range(ACTIONWEIGHTS[action])]
+    trace = []
+    for i in range(steps):
+        action = rng.choice(weighted)
+        step = {'action': action}
+        if action in ('rename', 'priorityDrag', 'status', 'delete'):
+            step['row'] = rng.randint(0, 10000)
+        if action == 'rename':
+            step['name'] = 'renamed task %s' % i
+        elif action == 'priorityDrag':
+            step['distance'] = rng.choice((-1, 1)) * rng.randint(50, 250)
+        elif action == 'status':
+            step['status'] = rng.randint(0, 2)
+        trace.append(step)
+    return trace
+
+
+def isLightRow(taskWidget):
+    return isinstance(taskWidget, ToDoList.LightTaskWidget)
+
+
+class Replayer(object):
+    '''Drive a MainWindow through a trace the way a user would and time every interaction'''
+
+    def __init__(self, panel):
+        self.panel = panel
+        self.latencies = dict((action, []) for action in ACTIONS)
+
+    def waitForLoading(self):
+        while self.panel.isLoading():
+            QtGui.QApplication.processEvents(QtCore.QEventLoop.AllEvents, 50)
+
+    def taskWidget(self, step):
+        taskWidgets = self.panel.taskWidgets
+        if not taskWidgets:
+            return None
+        return taskWidgets[step.get('row', 0) % len(taskWidgets)]
+
+    def replay(self, trace):
+        for step in trace:
+            action = step['action']
+            start = time.time()
+            if getattr(self, action)(step) is False:
+                # NOTHING TO INTERACT WITH
+                continue
+            QtGui.QApplication.processEvents()
+            self.latencies[action].append(time.time() - start)
+
+    def add(self, step):
+        QtTest.QTest.mouseClick(self.panel.addTaskButton, QtCore.Qt.LeftButton)
+
+    def rename(self, step):
+        taskWidget = self.taskWidget(step)
+        if not taskWidget:
+            return False
+        taskWidget.editName()
+        nameWidget = taskWidget.editor if isLightRow(taskWidget) else taskWidget.taskNameWidget
+        QtTest.QTest.keyClicks(nameWidget, step.get('name', 'renamed task'))
+        QtTest.QTest.keyClick(nameWidget, QtCore.Qt.Key_Return)
+
+    def priorityDrag(self, step):
+        '''alt+LMB drag across the priority widget, then leave it to trigger the re-sort'''
+        taskWidget = self.taskWidget(step)
+        if not taskWidget:
+            return False
+        if isLightRow(taskWidget):
+            priorityWidget = taskWidget
+            origin = taskWidget.fieldRects()['priority'].center()
+        else:
+            priorityWidget = taskWidget.priorityWidget
+            origin = priorityWidget.rect().center()
+        distance = step.get('distance', 100)
+        # HOVER FIRST, LIGHT ROWS ONLY RE-SORT WHEN THE MOUSE LEAVES A PRIORITY IT WAS OVER
+        QtGui.QApplication.sendEvent(priorityWidget, QtGui.QMouseEvent(QtCore.QEvent.MouseMove, origin,
+                                                                       QtCore.Qt.NoButton, QtCore.Qt.NoButton, QtCore.Qt.NoModifier))
+        QtGui.QApplication.sendEvent(priorityWidget, QtGui.QMouseEvent(QtCore.QEvent.MouseButtonPress, origin,
+                                                                       QtCore.Qt.LeftButton, QtCore.Qt.LeftButton, QtCore.Qt.AltModifier))
+        for x in range(0, distance, 10 if distance > 0 else -10):
+            QtGui.QApplication.sendEvent(priorityWidget, QtGui.QMouseEvent(QtCore.QEvent.MouseMove, origin + QtCore.QPoint(x, 0),
+                                                                           QtCore.Qt.NoButton, QtCore.Qt.LeftButton, QtCore.Qt.AltModifier))
+        QtGui.QApplication.sendEvent(priorityWidget, QtGui.QMouseEvent(QtCore.QEvent.MouseButtonRelease, origin + QtCore.QPoint(distance, 0),
+                                                                       QtCore.Qt.LeftButton, QtCore.Qt.NoButton, QtCore.Qt.AltModifier))
+        QtGui.QApplication.sendEvent(priorityWidget, QtCore.QEvent(QtCore.QEvent.Leave))
+
+    def status(self, step):
+        taskWidget = self.taskWidget(step)
+        if not taskWidget:
+            return False
+        if isLightRow(taskWidget):
+            taskWidget.setStatus(step.get('status', 1))
+        else:
+            taskWidget.statusWidget.setCurrentIndex(step.get('status', 1))
+
+    def delete(self, step):
+        taskWidget = self.taskWidget(step)
+        if not taskWidget:
+            return False
+        if isLightRow(taskWidget):
+            QtTest.QTest.mouseClick(taskWidget, QtCore.Qt.LeftButton, QtCore.Qt.NoModifier, taskWidget.fieldRects()['delete'].center())
+        else:
+            QtTest.QTest.mouseClick(taskWidget.deleteWidget, QtCore.Qt.LeftButton)
+
+    def toggleHide(self, step):
+        QtTest.QTest.mouseClick(self.panel.hideButton, QtCore.Qt.LeftButton)
+
+    def toggleSort(self, step):
+        QtTest.QTest.mouseClick(self.panel.sortButton, QtCore.Qt.LeftButton)
+
+
+def percentile(values, p):
+    '''Return the p-th percentile of values (nearest rank)'''
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def report(latencies, writeCounter, steps, duration):
+    '''Return the latency and disk write summary of a replay'''
+    lines = ['%-14s %6s %9s %9s %9s %9s' % ('interaction', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+    for action in ACTIONS:
+        values = latencies[action]
+        if not values:
+            continue
+        lines.append('%-14s %6d %9.1f %9.1f %9.1f %9.1f' % (action,
+                                                           len(values),
+                                                           percentile(values, 50) * 1000,
+                                                           percentile(values, 90) * 1000,
+                                                           percentile(values, 99) * 1000,
+                                                           max(values) * 1000))
+    lines.append('%s interactions in %.1fs' % (steps, duration))
+    lines.append('disk writes: %s (%.1f per interaction, %.1f MB)' % (writeCounter.writes,
+                                                                    float(writeCounter.writes) / steps if steps else 0,
+                                                                    writeCounter.bytes / 1024.0 / 1024.0))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replay interactions against the ToDoList panel and report latencies and disk writes')
+    parser.add_argument('--tasks', type=int, default=500, help='number of tasks in the generated task file')
+    parser.add_argument('--steps', type=int, default=200, help='number of interactions in a synthetic trace')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generated tasks and trace')
+    parser.add_argument('--trace', help='json trace to replay instead of a synthetic one')
+    parser.add_argument('--save-trace', dest='saveTrace', help='write the replayed trace to this json file')
+    parser.add_argument('--light', action='store_true', help='use the lightweight single widget task rows')
+    options = parser.parse_args(args)
+    if options.light:
+        ToDoList.MainWindow.LIGHTWEIGHTROWS = True
+
+    if options.trace:
+        with open(options.trace) as f:
+            trace = json.load(f)
+    else:
+        trace = syntheticTrace(options.steps, options.seed)
+    if options.saveTrace:
+        with open(options.saveTrace, 'w') as f:
+            json.dump(trace, f, indent=1)
+
+    app = QtGui.QApplication.instance() or QtGui.QApplication([])
+    tmpDir = tempfile.mkdtemp(prefix='ToDoListReplay')
+    writeCounter = WriteCounter()
+    try:
+        tasksFile = os.path.join(tmpDir, 'replay_toDoSettings.xml')
+        generateTasksFile(tasksFile, options.tasks, options.seed)
+
+        panel = ToDoList.MainWindow(settingsFile=tasksFile)
+        panel.resize(600, 800)
+        panel.show()
+        replayer = Replayer(panel)
+        loadStart = time.time()
+        replayer.waitForLoading()
+        print 'loaded %s tasks in %.2fs' % (options.tasks, time.time() - loadStart)
+
+        writeCounter.install()
+        start = time.time()
+        replayer.replay(trace)
+        duration = time.time() - start
+        writeCounter.uninstall()
+
+        panel.close()
+        print report(replayer.latencies, writeCounter, len(trace), duration)
+    finally:
+        writeCounter.uninstall()
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()